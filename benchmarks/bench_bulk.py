@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+from typing import Any, Dict, List, Optional
+
+from benchmarks.bench_codec import make_vectors
+from embeddings.docstore import RedisStore
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="bench-bulk", description="Compare RedisStore bulk write and scan throughput across pipeline modes."
+    )
+    parser.add_argument(
+        "--url", type=str, default=None, help="redis url, an in-process fakeredis server is used when omitted"
+    )
+    parser.add_argument(
+        "--num-docs", type=int, default=100_000, help="number of documents written and scanned"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=384, help="embedding dim"
+    )
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[500, 2000], help="commands per pipeline"
+    )
+    parser.add_argument(
+        "--parallelism", type=int, nargs="+", default=[1, 4, 8], help="pipelines in flight"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed"
+    )
+
+    return parser.parse_args()
+
+
+def make_store(
+    url: Optional[str], batch_size: int, pipeline_parallelism: int, transactional_pipelines: bool
+) -> RedisStore:
+    store = RedisStore(
+        url=url or 'redis://localhost',
+        index_name='bench_bulk',
+        batch_size=batch_size,
+        pipeline_parallelism=pipeline_parallelism,
+        transactional_pipelines=transactional_pipelines,
+    )
+    if url is None:
+        import fakeredis
+        store.client = fakeredis.FakeAsyncRedis()
+    return store
+
+
+async def bench_mode(
+    args: argparse.Namespace,
+    datas: Dict[str, Any],
+    batch_size: int,
+    parallelism: int,
+    transactional: bool,
+) -> Dict[str, Any]:
+    store = make_store(args.url, batch_size, parallelism, transactional)
+    # only the keys of the benchmark index, the database may be shared
+    await store.drop()
+
+    start = time.perf_counter()
+    await store.add(datas)
+    add_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, scanned = await store.scan_all()
+    scan_seconds = time.perf_counter() - start
+
+    await store.drop()
+    return {
+        'batch_size': batch_size,
+        'parallelism': parallelism,
+        'transactional': transactional,
+        'add_docs_per_sec': len(datas) / add_seconds,
+        'scan_docs_per_sec': len(scanned) / scan_seconds,
+    }
+
+
+async def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(rng, args.num_docs, args.dim)
+    datas = {f'doc{i}': (f'document {i}', vectors[i], {'group': i % 10}) for i in range(args.num_docs)}
+
+    results: List[Dict[str, Any]] = []
+    for batch_size in args.batch_sizes:
+        # the mode before bulk pipelines were configurable comes first as the baseline
+        baseline = await bench_mode(args, datas, batch_size, 1, True)
+        results.append(baseline)
+        print(json.dumps(baseline))
+        for parallelism in args.parallelism:
+            result = await bench_mode(args, datas, batch_size, parallelism, False)
+            result['add_speedup'] = result['add_docs_per_sec'] / baseline['add_docs_per_sec']
+            result['scan_speedup'] = result['scan_docs_per_sec'] / baseline['scan_docs_per_sec']
+            results.append(result)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+import argparse
+import json
+import time
+import numpy as np
+
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from embeddings.codec import VectorCodec, decode_vector, encode_vector
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="bench-codec", description="Measure memory saved and recall lost by each vector codec."
+    )
+    parser.add_argument(
+        "--num-vectors", type=int, default=20_000, help="number of stored vectors"
+    )
+    parser.add_argument(
+        "--num-queries", type=int, default=200, help="number of queries"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=1536, help="embedding dim"
+    )
+    parser.add_argument(
+        "--k", type=int, default=10, help="number of neighbors compared for recall"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed"
+    )
+
+    return parser.parse_args()
+
+
+def make_vectors(rng: np.random.Generator, n: int, dim: int) -> np.ndarray:
+    # unit vectors around a few hundred topics, closer to real embeddings than iid noise
+    centers = rng.standard_normal((max(1, n // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main():
+    args = parse_args()
+    faiss = dependable_faiss_import()
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(rng, args.num_vectors + args.num_queries, args.dim)
+    vectors, queries = vectors[:args.num_vectors], vectors[args.num_vectors:]
+
+    _, expected = faiss.knn(queries, vectors, args.k, faiss.METRIC_INNER_PRODUCT)
+    baseline = None
+    for codec in VectorCodec:
+        start = time.perf_counter()
+        encoded = [encode_vector(vector, codec) for vector in vectors]
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = np.stack([decode_vector(data, codec) for data in encoded])
+        decode_s = time.perf_counter() - start
+
+        _, found = faiss.knn(queries, decoded, args.k, faiss.METRIC_INNER_PRODUCT)
+        hits = sum(len(set(row).intersection(exact_row)) for row, exact_row in zip(found, expected))
+        total_bytes = sum(len(data) for data in encoded)
+        baseline = baseline or total_bytes
+        print(json.dumps({
+            'codec': codec.value,
+            'dim': args.dim,
+            'bytes_per_vector': total_bytes / len(encoded),
+            'memory_saved': 1 - total_bytes / baseline,
+            f'recall@{args.k}': hits / expected.size,
+            'max_abs_error': float(np.abs(decoded - vectors).max()),
+            'encode_us_per_vector': encode_s * 1e6 / len(encoded),
+            'decode_us_per_vector': decode_s * 1e6 / len(encoded),
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import time
+import numpy as np
+
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain.vectorstores.utils import maximal_marginal_relevance as reference_mmr
+
+from benchmarks.bench_codec import make_vectors
+from embeddings.mmr import maximal_marginal_relevance
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="bench-mmr", description="Compare the per-id and the vectorized mmr paths of FaissSearcher."
+    )
+    parser.add_argument(
+        "--num-vectors", type=int, default=50_000, help="number of indexed vectors"
+    )
+    parser.add_argument(
+        "--num-queries", type=int, default=100, help="number of queries"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=1536, help="embedding dim"
+    )
+    parser.add_argument(
+        "--fetch-k", type=int, default=100, help="candidates passed to mmr"
+    )
+    parser.add_argument(
+        "--k", type=int, default=10, help="documents selected by mmr"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    faiss = dependable_faiss_import()
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(rng, args.num_vectors + args.num_queries, args.dim)
+    vectors, queries = vectors[:args.num_vectors], vectors[args.num_vectors:]
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(args.dim))
+    index.add_with_ids(vectors, np.arange(args.num_vectors, dtype=np.int64))
+    _, candidates = index.search(queries, args.fetch_k)
+
+    timings = {'loop': [0.0, 0.0], 'vectorized': [0.0, 0.0]}
+    mismatches = 0
+    for query, keys in zip(queries, candidates):
+        start = time.perf_counter()
+        embeddings = [index.reconstruct(int(i)) for i in keys]
+        reconstructed = time.perf_counter()
+        expected = reference_mmr(np.array([query]), embeddings, k=args.k)
+        timings['loop'][0] += reconstructed - start
+        timings['loop'][1] += time.perf_counter() - reconstructed
+
+        start = time.perf_counter()
+        embeddings = index.reconstruct_batch(keys)
+        reconstructed = time.perf_counter()
+        found = maximal_marginal_relevance(query, embeddings, k=args.k)
+        timings['vectorized'][0] += reconstructed - start
+        timings['vectorized'][1] += time.perf_counter() - reconstructed
+        mismatches += found != expected
+
+    for path, (reconstruct_s, select_s) in timings.items():
+        print(json.dumps({
+            'path': path,
+            'dim': args.dim,
+            'fetch_k': args.fetch_k,
+            'k': args.k,
+            'reconstruct_ms': reconstruct_s * 1000 / len(queries),
+            'select_ms': select_s * 1000 / len(queries),
+            'total_ms': (reconstruct_s + select_s) * 1000 / len(queries),
+        }))
+    print(json.dumps({'queries': len(queries), 'selection_mismatches': mismatches}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import time
+import numpy as np
+
+from embeddings.codec import (
+    ContentCodec,
+    MetadataCodec,
+    decode_content,
+    decode_metadata,
+    encode_content,
+    encode_metadata,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="bench-serialization", description="Measure metadata and content codec speed and size."
+    )
+    parser.add_argument(
+        "--num-docs", type=int, default=100_000, help="number of serialized documents"
+    )
+    parser.add_argument(
+        "--content-size", type=int, default=2000, help="characters per content"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed"
+    )
+
+    return parser.parse_args()
+
+
+def make_metadata(rng: np.random.Generator, i: int) -> dict:
+    return {
+        'source': f'https://docs.example.org/page/{i}',
+        'chain': ['ethereum', 'arbitrum', 'base'][i % 3],
+        'block': int(rng.integers(0, 20_000_000)),
+        'tags': [f'tag{j}' for j in rng.integers(0, 50, 4)],
+        'score': float(rng.random()),
+    }
+
+
+def bench(name: str, codec: str, items: list, encode, decode) -> dict:
+    start = time.perf_counter()
+    encoded = [encode(item) for item in items]
+    encode_s = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in encoded:
+        decode(data)
+    decode_s = time.perf_counter() - start
+    return {
+        'field': name,
+        'codec': codec,
+        'encode_us': encode_s * 1e6 / len(items),
+        'decode_us': decode_s * 1e6 / len(items),
+        'bytes': sum(len(data) for data in encoded) / len(items),
+    }
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    metadatas = [make_metadata(rng, i) for i in range(args.num_docs)]
+    words = ['swap', 'pool', 'liquidity', 'token', 'fee', 'router', 'price', 'oracle', 'vault', 'stake']
+    contents = [
+        ' '.join(rng.choice(words, args.content_size // 6)) for _ in range(min(args.num_docs, 10_000))
+    ]
+
+    for codec in MetadataCodec:
+        try:
+            result = bench(
+                'metadata', codec.value, metadatas,
+                lambda metadata: encode_metadata(metadata, codec),
+                lambda data: decode_metadata(data, codec),
+            )
+        except ImportError as e:
+            result = {'field': 'metadata', 'codec': codec.value, 'skipped': str(e)}
+        print(json.dumps(result))
+    for codec in ContentCodec:
+        try:
+            result = bench(
+                'content', codec.value, contents,
+                lambda content: encode_content(content, codec),
+                lambda data: decode_content(data, codec),
+            )
+        except ImportError as e:
+            result = {'field': 'content', 'codec': codec.value, 'skipped': str(e)}
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import time
+import numpy as np
+
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain.vectorstores.utils import DistanceStrategy
+
+from benchmarks.bench_codec import make_vectors
+from embeddings.index import ShardedIndex, create_flat_index
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="bench-shards", description="Measure single query flat search latency against the number of shards."
+    )
+    parser.add_argument(
+        "--num-vectors", type=int, default=1_000_000, help="number of indexed vectors"
+    )
+    parser.add_argument(
+        "--num-queries", type=int, default=200, help="number of queries, searched one at a time"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=384, help="embedding dim"
+    )
+    parser.add_argument(
+        "--k", type=int, default=10, help="number of neighbors"
+    )
+    parser.add_argument(
+        "--shards", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="shard counts to compare"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    faiss = dependable_faiss_import()
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(rng, args.num_vectors + args.num_queries, args.dim)
+    vectors, queries = vectors[:args.num_vectors], vectors[args.num_vectors:]
+    keys = np.arange(args.num_vectors, dtype=np.int64)
+
+    baseline = None
+    expected = None
+    for num_shards in args.shards:
+        if num_shards == 1:
+            index = faiss.IndexIDMap2(create_flat_index(args.dim, DistanceStrategy.EUCLIDEAN_DISTANCE))
+        else:
+            index = ShardedIndex(args.dim, DistanceStrategy.EUCLIDEAN_DISTANCE, num_shards)
+        index.add_with_ids(vectors, keys)
+
+        found = []
+        start = time.perf_counter()
+        for query in queries:
+            _, labels = index.search(query.reshape(1, -1), args.k)
+            found.append(labels[0])
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        found = np.array(found)
+        expected = found if expected is None else expected
+        baseline = baseline or latency_ms
+        print(json.dumps({
+            'shards': num_shards,
+            'num_vectors': args.num_vectors,
+            'dim': args.dim,
+            'latency_ms': latency_ms,
+            'speedup': baseline / latency_ms,
+            'same_results': bool((found == expected).all()),
+        }))
+
+
+if __name__ == "__main__":
+    main()
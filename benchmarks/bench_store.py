@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import platform
+import resource
+import subprocess
+import time
+import numpy as np
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from langchain.embeddings.base import Embeddings
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from embeddings.docstore import RedisStore
+from embeddings.index import IndexKind, IndexSpec
+from embeddings.redis_searcher import RedisSearcher
+from embeddings.searcher import FaissSearcher
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="bench-store", description="Benchmark FaissSearcher or RedisSearcher and RedisStore on synthetic embeddings."
+    )
+    parser.add_argument(
+        "--engine", type=str, choices=["faiss", "redis-flat", "redis-hnsw"], default="faiss",
+        help="search engine, the redis ones need --url to point at a redis with the search module"
+    )
+    parser.add_argument(
+        "--url", type=str, default=None, help="redis url, an in-process fakeredis server is used when omitted"
+    )
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="corpus sizes to benchmark"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=256, help="embedding dim"
+    )
+    parser.add_argument(
+        "--num-queries", type=int, default=200, help="queries per search benchmark"
+    )
+    parser.add_argument(
+        "--k", type=int, default=4, help="number of documents per search"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="documents per aadd_texts call and docstore pipeline"
+    )
+    parser.add_argument(
+        "--delete-size", type=int, default=100, help="documents per adelete call"
+    )
+    parser.add_argument(
+        "--output", type=str, default="bench_results.json", help="file the results are written to"
+    )
+
+    args = parser.parse_args()
+    if args.engine != "faiss" and args.url is None:
+        parser.error(f"--engine {args.engine} needs --url, fakeredis has no search module")
+    return args
+
+
+class SyntheticEmbeddings(Embeddings):
+    """Deterministic unit vectors seeded by the text, no model calls."""
+
+    dim: int
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return self.embed_query(text)
+
+
+class RoundTrips:
+    """Counts the requests a redis client sends, a pipeline execute counts once."""
+
+    count: int
+
+    def __init__(self, client: Any):
+        self.count = 0
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        async def counted_execute_command(*args, **kwargs):
+            self.count += 1
+            return await execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def counted_execute(*execute_args, **execute_kwargs):
+                self.count += 1
+                return await execute(*execute_args, **execute_kwargs)
+
+            pipe.execute = counted_execute
+            return pipe
+
+        client.execute_command = counted_execute_command
+        client.pipeline = counted_pipeline
+
+
+def make_store(url: Optional[str], index_name: str, batch_size: int) -> RedisStore:
+    store = RedisStore(
+        url=url or 'redis://localhost', index_name=index_name, batch_size=batch_size, filterable_metadata=['group']
+    )
+    if url is None:
+        import fakeredis
+        store.client = fakeredis.FakeAsyncRedis()
+    return store
+
+
+def make_searcher(engine: str, store: RedisStore, dim: int, embeddings: Embeddings) -> Any:
+    if engine == 'faiss':
+        return FaissSearcher(store, dim, embeddings)
+    kind = IndexKind.HNSW if engine == 'redis-hnsw' else IndexKind.FLAT
+    return RedisSearcher(store, dim, embeddings, index_spec=IndexSpec(kind=kind))
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    values = np.array(samples) * 1000
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'mean_ms': float(values.mean()),
+    }
+
+
+async def measure_queries(
+    round_trips: RoundTrips, queries: List[str], search: Callable[[str], Any]
+) -> Dict[str, float]:
+    latencies = []
+    before = round_trips.count
+    for query in queries:
+        start = time.perf_counter()
+        await search(query)
+        latencies.append(time.perf_counter() - start)
+    result = percentiles(latencies)
+    result['round_trips_per_query'] = (round_trips.count - before) / len(queries)
+    return result
+
+
+async def bench_scale(args: argparse.Namespace, scale: int) -> Dict[str, Any]:
+    embeddings = SyntheticEmbeddings(args.dim)
+    store = make_store(args.url, f'bench{scale}', args.batch_size)
+    # only the keys of the benchmark index, the database may be shared
+    await store.drop()
+    round_trips = RoundTrips(store.client)
+    searcher = make_searcher(args.engine, store, args.dim, embeddings)
+    await searcher.init()
+    result: Dict[str, Any] = {'scale': scale, 'dim': args.dim, 'engine': args.engine}
+
+    start = time.perf_counter()
+    ids = []
+    for offset in range(0, scale, args.batch_size):
+        size = min(args.batch_size, scale - offset)
+        texts = [f'document {i}' for i in range(offset, offset + size)]
+        metadatas = [{'group': i % 10} for i in range(offset, offset + size)]
+        ids.extend(await searcher.aadd_texts(texts, metadatas))
+    elapsed = time.perf_counter() - start
+    result['add'] = {'seconds': elapsed, 'docs_per_sec': scale / elapsed}
+
+    reader = make_searcher(args.engine, store, args.dim, embeddings)
+    start = time.perf_counter()
+    await reader.init()
+    result['init'] = {'seconds': time.perf_counter() - start}
+
+    queries = [f'query {i}' for i in range(args.num_queries)]
+    result['search'] = await measure_queries(
+        round_trips, queries, lambda query: searcher.asimilarity_search(query, k=args.k)
+    )
+    result['search_filtered'] = await measure_queries(
+        round_trips, queries, lambda query: searcher.asimilarity_search(query, k=args.k, filter={'group': 3})
+    )
+    result['mmr'] = await measure_queries(
+        round_trips, queries, lambda query: searcher.amax_marginal_relevance_search(query, k=args.k)
+    )
+
+    latencies = []
+    for offset in range(0, min(len(ids), 10 * args.delete_size), args.delete_size):
+        start = time.perf_counter()
+        await searcher.adelete(ids[offset:offset + args.delete_size])
+        latencies.append(time.perf_counter() - start)
+    result['delete'] = percentiles(latencies)
+    result['delete']['docs_per_call'] = args.delete_size
+
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if args.engine != 'faiss':
+        await searcher.adrop_index()
+    await store.drop()
+    return result
+
+
+def environment(url: Optional[str]) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'backend': 'redis' if url else 'fakeredis',
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'faiss': dependable_faiss_import().__version__,
+        'machine': platform.machine(),
+    }
+
+
+async def main():
+    args = parse_args()
+    results = []
+    for scale in args.scales:
+        result = await bench_scale(args, scale)
+        print(json.dumps(result))
+        results.append(result)
+    Path(args.output).write_text(json.dumps({'environment': environment(args.url), 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+import json
+import numpy as np
+
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+
+class VectorCodec(str, Enum):
+    """Byte encoding of the vectors stored in the docstore."""
+
+    FLOAT32 = 'float32'
+    FLOAT16 = 'float16'
+    INT8 = 'int8'
+    """int8 components prefixed by the float32 scale of the vector"""
+
+
+def encode_vector(vector: List[float], codec: VectorCodec) -> bytes:
+    vector = np.asarray(vector, dtype=np.float32)
+    if codec == VectorCodec.FLOAT32:
+        return vector.tobytes()
+    elif codec == VectorCodec.FLOAT16:
+        return vector.astype(np.float16).tobytes()
+    elif codec == VectorCodec.INT8:
+        peak = float(np.abs(vector).max()) if len(vector) > 0 else 0.0
+        scale = np.float32(peak / 127 if peak > 0 else 1.0)
+        codes = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return scale.tobytes() + codes.tobytes()
+    else:
+        raise ValueError(f'unknown vector codec: {codec}')
+
+
+def decode_vector(data: bytes, codec: VectorCodec) -> np.ndarray:
+    """Decode a stored vector back to float32."""
+    if codec == VectorCodec.FLOAT32:
+        return np.frombuffer(data, dtype=np.float32)
+    elif codec == VectorCodec.FLOAT16:
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+    elif codec == VectorCodec.INT8:
+        scale = np.frombuffer(data, dtype=np.float32, count=1)[0]
+        return np.frombuffer(data, dtype=np.int8, offset=4).astype(np.float32) * scale
+    else:
+        raise ValueError(f'unknown vector codec: {codec}')
+
+
+def decode_vectors(datas: List[bytes], codec: VectorCodec) -> np.ndarray:
+    """Decode stored vectors of the same dim into one writable float32 matrix, copying
+    the bytes once instead of going through a vector per row."""
+    if not datas:
+        return np.empty((0, 0), dtype=np.float32)
+    buffer = bytearray().join(datas)
+    if codec == VectorCodec.FLOAT32:
+        return np.frombuffer(buffer, dtype=np.float32).reshape(len(datas), -1)
+    elif codec == VectorCodec.FLOAT16:
+        return np.frombuffer(buffer, dtype=np.float16).reshape(len(datas), -1).astype(np.float32)
+    elif codec == VectorCodec.INT8:
+        rows = np.frombuffer(buffer, dtype=np.uint8).reshape(len(datas), -1)
+        scales = rows[:, :4].copy().view(np.float32)
+        return rows[:, 4:].view(np.int8).astype(np.float32) * scales
+    else:
+        raise ValueError(f'unknown vector codec: {codec}')
+
+
+class MetadataCodec(str, Enum):
+    """Serialization of the metadata stored in the docstore."""
+
+    JSON = 'json'
+    ORJSON = 'orjson'
+    MSGPACK = 'msgpack'
+    """msgpack keeps non-string dict keys as they are, unlike json"""
+
+
+class ContentCodec(str, Enum):
+    """Byte encoding of the contents stored in the docstore."""
+
+    PLAIN = 'plain'
+    ZSTD = 'zstd'
+
+
+def dependable_orjson_import() -> Any:
+    try:
+        import orjson
+    except ImportError:
+        raise ImportError(
+            "Could not import orjson python package. "
+            "Please install it with `pip install orjson`."
+        )
+    return orjson
+
+
+def dependable_msgpack_import() -> Any:
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError(
+            "Could not import msgpack python package. "
+            "Please install it with `pip install msgpack`."
+        )
+    return msgpack
+
+
+def dependable_zstd_import() -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "Could not import zstandard python package. "
+            "Please install it with `pip install zstandard`."
+        )
+    return zstandard
+
+
+def check_codec_dependencies(metadata_codec: MetadataCodec, content_codec: ContentCodec):
+    """Raise early if the package a codec needs isn't installed."""
+    if metadata_codec == MetadataCodec.ORJSON:
+        dependable_orjson_import()
+    elif metadata_codec == MetadataCodec.MSGPACK:
+        dependable_msgpack_import()
+    if content_codec == ContentCodec.ZSTD:
+        dependable_zstd_import()
+
+
+def metadata_codec_of(marker: Optional[bytes]) -> MetadataCodec:
+    """Codec recorded next to a stored metadata, entries written before codecs are json."""
+    return MetadataCodec(marker.decode()) if marker is not None else MetadataCodec.JSON
+
+
+def content_codec_of(marker: Optional[bytes]) -> ContentCodec:
+    """Codec recorded next to a stored content, entries written before codecs are plain."""
+    return ContentCodec(marker.decode()) if marker is not None else ContentCodec.PLAIN
+
+
+def encode_metadata(metadata: Dict, codec: MetadataCodec) -> bytes:
+    if codec == MetadataCodec.JSON:
+        return json.dumps(metadata).encode()
+    elif codec == MetadataCodec.ORJSON:
+        orjson = dependable_orjson_import()
+        # json turns non-string keys into strings, orjson refuses them unless asked
+        return orjson.dumps(metadata, option=orjson.OPT_NON_STR_KEYS)
+    elif codec == MetadataCodec.MSGPACK:
+        return dependable_msgpack_import().packb(metadata, use_bin_type=True)
+    else:
+        raise ValueError(f'unknown metadata codec: {codec}')
+
+
+def decode_metadata(data: bytes, codec: MetadataCodec) -> Dict:
+    if codec == MetadataCodec.JSON:
+        return json.loads(data)
+    elif codec == MetadataCodec.ORJSON:
+        return dependable_orjson_import().loads(data)
+    elif codec == MetadataCodec.MSGPACK:
+        return dependable_msgpack_import().unpackb(data, raw=False, strict_map_key=False)
+    else:
+        raise ValueError(f'unknown metadata codec: {codec}')
+
+
+def encode_content(content: str, codec: ContentCodec) -> bytes:
+    if codec == ContentCodec.PLAIN:
+        return content.encode()
+    elif codec == ContentCodec.ZSTD:
+        return dependable_zstd_import().ZstdCompressor().compress(content.encode())
+    else:
+        raise ValueError(f'unknown content codec: {codec}')
+
+
+def decode_content(data: bytes, codec: ContentCodec) -> str:
+    if codec == ContentCodec.PLAIN:
+        return data.decode()
+    elif codec == ContentCodec.ZSTD:
+        return dependable_zstd_import().ZstdDecompressor().decompress(data).decode()
+    else:
+        raise ValueError(f'unknown content codec: {codec}')
@@ -1,20 +1,104 @@
+import asyncio
+import hashlib
 import json
-import numpy as np
+import uuid
 
-from typing import Optional, Dict, Tuple, List, Iterable
+from collections.abc import AsyncIterable
+from typing import (
+    Any, Optional, Dict, Set, Tuple, List, Iterable, AsyncIterator, Callable, Sequence, TypeVar, Union
+)
 from redis.asyncio import Redis as RedisClient
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.client import Pipeline
 from langchain.schema.document import Document
 
+from embeddings.codec import (
+    ContentCodec,
+    MetadataCodec,
+    VectorCodec,
+    check_codec_dependencies,
+    content_codec_of,
+    decode_content,
+    decode_metadata,
+    decode_vector,
+    decode_vectors,
+    encode_content,
+    encode_metadata,
+    encode_vector,
+    metadata_codec_of,
+)
+from embeddings.docstore_base import Change, ChangeOp, VectorPage, chunks, content_hash
+from embeddings.lru import LRUCache
+
+T = TypeVar('T')
+
+
+def filter_tag(value: Any) -> str:
+    """Tag a filterable metadata value is indexed under, a missing key is tagged as None.
+
+    Scalars equal in python get the same tag, as they match the same documents in the
+    MetadataIndex of FaissSearcher: True, 1 and 1.0 are tagged alike. Lists and dicts
+    are compared by their json form there, and here.
+    """
+    if isinstance(value, bool):
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
 
 class RedisStore:
-    """Redis store for documents."""
+    """Redis store for documents.
+
+    Every write is also appended to a per-index change stream, so that searchers can
+    catch up with the documents changed since they last synced their index. A per-index
+    hash maps the sha256 of every stored content to a document holding it, so that
+    ingestion can skip or reuse the embedding of content it has seen before. A per-index
+    set registers the id of every stored document, so that enumerating an index scans
+    that set rather than the whole keyspace.
 
-    client: RedisClient
+    Vectors are stored with the codec recorded for the index, which the first writer
+    records and readers pick up, see `vector_codec`.
+
+    The metadata keys listed in `filterable_metadata` are also written to hash fields of
+    their own, holding the `filter_tag` of their value, for a redis search index to
+    filter on, see RedisSearcher.
+
+    With a document cache, parsed documents are kept in process so that hot documents
+    are served without a round trip. Writes through this store invalidate it, writes of
+    other replicas are picked up once they are invalidated from the change stream (see
+    `invalidate`) or their entries expire.
+
+    In cluster mode the per-index keys share the `{index_name}` hash tag, so they live in
+    one slot, while every document key is tagged by its own id and spread over the
+    cluster. Cluster pipelines are split by slot and sent to every node at once.
+    """
+
+    client: Union[RedisClient, RedisCluster]
+    cluster: bool
     index_name: str
     batch_size: int
     content_key: bytes
     metadata_key: bytes
     vector_key: bytes
+    content_hash_key: bytes
+    metadata_codec_key: bytes
+    content_codec_key: bytes
+    metadata_codec: MetadataCodec
+    content_compression_threshold: Optional[int]
+    changelog_maxlen: int
+    replica_id: str
+    # codec asked for by the caller, None to use whatever the index records
+    _configured_codec: Optional[VectorCodec]
+    _codec: Optional[VectorCodec]
+    document_cache: Optional[LRUCache[Document]]
+    # bumped on every invalidation, reads racing with one don't fill the cache
+    _invalidations: int
+    # set once the index is known to have a complete id registry
+    _id_registry_ready: bool
+    pipeline_parallelism: int
+    transactional_pipelines: bool
+    filterable_metadata: Tuple[str, ...]
 
     def __init__(
         self,
@@ -25,14 +109,78 @@ class RedisStore:
         content_key: bytes = b'content',
         metadata_key: bytes = b'metadata',
         vector_key: bytes = b'content_vector',
+        content_hash_key: bytes = b'content_hash',
+        metadata_codec_key: bytes = b'metadata_codec',
+        content_codec_key: bytes = b'content_codec',
+        changelog_maxlen: int = 100_000,
+        replica_id: Optional[str] = None,
+        vector_codec: Optional[VectorCodec] = None,
+        metadata_codec: MetadataCodec = MetadataCodec.JSON,
+        content_compression_threshold: Optional[int] = None,
+        filterable_metadata: Sequence[str] = (),
+        document_cache_size: int = 0,
+        document_cache_ttl: Optional[float] = None,
+        pipeline_parallelism: int = 1,
+        transactional_pipelines: Optional[bool] = None,
+        cluster: bool = False,
+        max_connections: Optional[int] = None,
+        socket_timeout: Optional[float] = None,
+        socket_connect_timeout: Optional[float] = None,
+        health_check_interval: float = 0,
         **redis_kwargs,
     ):
-        self.client = RedisClient.from_url(url, **redis_kwargs)
+        """Bulk reads and writes are sent in pipelines of `batch_size` commands, with up to
+        `pipeline_parallelism` of them in flight over the connection pool. Pipelines are
+        MULTI/EXEC transactions unless `transactional_pipelines` is off, which is faster
+        for bulk loads but lets a failed batch be partially applied. Cluster pipelines
+        can't be transactions, they are off by default in cluster mode.
+
+        `max_connections` bounds the connection pool, per node in cluster mode. The
+        socket timeout must exceed the block time searchers wait for changes with, and
+        idle connections are pinged after `health_check_interval` seconds, 0 to never.
+
+        Metadata is written with `metadata_codec`, and contents of at least
+        `content_compression_threshold` bytes are zstd compressed. The codecs are recorded
+        in each hash, so entries written with other codecs, or none, are still read back.
+        Documents written before a key was made filterable get its field once they are
+        written again, e.g. by `update_metadatas`."""
+        if transactional_pipelines is None:
+            transactional_pipelines = not cluster
+        elif transactional_pipelines and cluster:
+            raise ValueError('transactional pipelines are not supported in cluster mode')
+        connection_kwargs = dict(
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout,
+            health_check_interval=health_check_interval,
+        )
+        if max_connections is not None:
+            connection_kwargs['max_connections'] = max_connections
+        client_class = RedisCluster if cluster else RedisClient
+        self.client = client_class.from_url(url, **connection_kwargs, **redis_kwargs)
+        self.cluster = cluster
         self.index_name = index_name
         self.batch_size = batch_size
         self.content_key = content_key
         self.metadata_key = metadata_key
         self.vector_key = vector_key
+        self.content_hash_key = content_hash_key
+        self.metadata_codec_key = metadata_codec_key
+        self.content_codec_key = content_codec_key
+        check_codec_dependencies(
+            metadata_codec, ContentCodec.ZSTD if content_compression_threshold is not None else ContentCodec.PLAIN
+        )
+        self.metadata_codec = metadata_codec
+        self.content_compression_threshold = content_compression_threshold
+        self.changelog_maxlen = changelog_maxlen
+        self.replica_id = replica_id or uuid.uuid4().hex
+        self._configured_codec = vector_codec
+        self._codec = None
+        self.document_cache = LRUCache(document_cache_size, document_cache_ttl) if document_cache_size > 0 else None
+        self._invalidations = 0
+        self._id_registry_ready = False
+        self.pipeline_parallelism = pipeline_parallelism
+        self.transactional_pipelines = transactional_pipelines
+        self.filterable_metadata = tuple(filterable_metadata)
 
     def _redis_prefix(self) -> str:
         return f'doc:{self.index_name}:'
@@ -41,95 +189,460 @@ class RedisStore:
         return self._redis_prefix() + '*'
 
     def _redis_key(self, _id: str) -> str:
+        if self.cluster:
+            # tagged by id so that braces in the index name can't pin documents to one slot
+            return self._redis_prefix() + '{' + _id + '}'
         return self._redis_prefix() + _id
 
     def _key_to_id(self, key: str) -> str:
-        return key.removeprefix(self._redis_prefix())
+        _id = key.removeprefix(self._redis_prefix())
+        if self.cluster:
+            return _id.removeprefix('{').removesuffix('}')
+        return _id
+
+    def _index_tag(self) -> str:
+        return '{' + self.index_name + '}' if self.cluster else self.index_name
+
+    def _ids_key(self) -> str:
+        return f'ids:{self._index_tag()}'
+
+    def _content_hashes_key(self) -> str:
+        return f'hashes:{self._index_tag()}'
+
+    def _meta_key(self) -> str:
+        return f'meta:{self._index_tag()}'
+
+    def _changelog_key(self) -> str:
+        return f'changes:{self._index_tag()}'
+
+    def _log_change(self, target: Union[Pipeline, RedisClient, RedisCluster], op: ChangeOp, ids: List[str]) -> Any:
+        """Append a change to the stream, queued on a pipeline or awaitable on a client."""
+        return target.xadd(
+            self._changelog_key(),
+            {'op': op.value, 'ids': json.dumps(ids), 'origin': self.replica_id},
+            maxlen=self.changelog_maxlen,
+            approximate=True,
+        )
+
+    async def _execute_logged(self, pipeline: Pipeline, op: ChangeOp, ids: List[str]) -> List[Any]:
+        """Execute the writes of `pipeline` and log them as a change."""
+        if not self.cluster:
+            self._log_change(pipeline, op, ids)
+            return await pipeline.execute()
+        # the documents live on other nodes than the change stream, a change must not be
+        # visible before the writes it points at have landed
+        outputs = await pipeline.execute()
+        await self._log_change(self.client, op, ids)
+        return outputs
+
+    @staticmethod
+    def _filter_field(key: str) -> bytes:
+        """Hash field holding the tag of the filterable metadata `key`."""
+        return f'filter_{key}'.encode()
+
+    def _encode_metadata(self, metadata: Dict) -> Dict[bytes, Any]:
+        """Hash fields storing `metadata` along with its codec marker and filter tags."""
+        return {
+            self.metadata_key: encode_metadata(metadata, self.metadata_codec),
+            self.metadata_codec_key: self.metadata_codec.value,
+            **{self._filter_field(key): filter_tag(metadata.get(key)) for key in self.filterable_metadata},
+        }
+
+    def _encode_content(self, content: str) -> Dict[bytes, Any]:
+        """Hash fields storing `content` along with its codec marker."""
+        data = content.encode()
+        codec = ContentCodec.PLAIN
+        if self.content_compression_threshold is not None and len(data) >= self.content_compression_threshold:
+            codec = ContentCodec.ZSTD
+            data = encode_content(content, codec)
+        return {self.content_key: data, self.content_codec_key: codec.value}
+
+    @staticmethod
+    def _decode_metadata(data: bytes, marker: Optional[bytes]) -> Dict:
+        return decode_metadata(data, metadata_codec_of(marker))
+
+    @staticmethod
+    def _decode_content(data: bytes, marker: Optional[bytes]) -> str:
+        return decode_content(data, content_codec_of(marker))
+
+    def _document_fields(self) -> Tuple[bytes, bytes, bytes, bytes]:
+        return self.content_key, self.content_codec_key, self.metadata_key, self.metadata_codec_key
+
+    def _parse_document(self, fields: List[Optional[bytes]]) -> Optional[Document]:
+        """Document from the values of `_document_fields`, None if it isn't stored."""
+        content, content_marker, metadata, metadata_marker = fields
+        if content is None or metadata is None:
+            return None
+        return Document(
+            page_content=self._decode_content(content, content_marker),
+            metadata=self._decode_metadata(metadata, metadata_marker),
+        )
+
+    async def vector_codec(self) -> VectorCodec:
+        """Codec the vectors of the index are stored with, recorded by the first writer.
+
+        Indexes written before codecs were recorded hold float32 vectors. Raises if the
+        codec the store was configured with differs, the index must be migrated first.
+        """
+        if self._codec is None:
+            recorded = await self.client.hget(self._meta_key(), 'vector_codec')
+            if recorded is None:
+                legacy = await self._has_documents()
+                codec = VectorCodec.FLOAT32 if legacy else (self._configured_codec or VectorCodec.FLOAT32)
+                if not legacy:
+                    # a new index, every document it will hold gets registered
+                    await self.client.hsetnx(self._meta_key(), 'id_registry', 1)
+                # concurrent first writers agree on whichever codec got recorded first
+                await self.client.hsetnx(self._meta_key(), 'vector_codec', codec.value)
+                recorded = await self.client.hget(self._meta_key(), 'vector_codec')
+            codec = VectorCodec(recorded.decode())
+            if self._configured_codec is not None and self._configured_codec != codec:
+                raise ValueError(
+                    f'index {self.index_name} stores {codec.value} vectors, '
+                    f'migrate it to {self._configured_codec.value} first'
+                )
+            self._codec = codec
+        return self._codec
+
+    async def _has_documents(self) -> bool:
+        if await self.client.scard(self._ids_key()) > 0:
+            return True
+        async for _ in self._scan_keyspace(self.batch_size):
+            return True
+        return False
+
+    async def _scan_keyspace(self, count: int) -> AsyncIterator[bytes]:
+        """Document keys found by matching the whole keyspace, of every node in cluster mode."""
+        async for key in self.client.scan_iter(self._redis_match(), count):
+            yield key
+
+    async def _ensure_id_registry(self):
+        """Register the documents of indexes written before the id registry existed,
+        with one last keyspace scan."""
+        if self._id_registry_ready:
+            return
+        if await self.client.hget(self._meta_key(), 'id_registry') is None:
+            batch = []
+            async for key in self._scan_keyspace(self.batch_size):
+                batch.append(self._key_to_id(key.decode()))
+                if len(batch) == self.batch_size:
+                    await self.client.sadd(self._ids_key(), *batch)
+                    batch = []
+            if batch:
+                await self.client.sadd(self._ids_key(), *batch)
+            await self.client.hset(self._meta_key(), 'id_registry', 1)
+        self._id_registry_ready = True
+
+    async def migrate_vector_codec(self, codec: VectorCodec) -> int:
+        """Re-encode every stored vector with `codec` and record it for the index.
+
+        Writers must be stopped while migrating, and readers restarted afterward.
+        Returns the number of vectors migrated.
+        """
+        self._configured_codec = None
+        current = await self.vector_codec()
+        migrated = 0
+        if current != codec:
+            async for ids in self._iter_id_batches(self.batch_size):
+                pipeline = self.client.pipeline()
+                for _id in ids:
+                    _ = pipeline.hget(self._redis_key(_id), self.vector_key)
+                datas = await pipeline.execute()
+                pipeline = self.client.pipeline()
+                for _id, data in zip(ids, datas):
+                    if data is None:
+                        continue
+                    vector = decode_vector(data, current)
+                    _ = pipeline.hset(self._redis_key(_id), self.vector_key, encode_vector(vector, codec))
+                    migrated += 1
+                await pipeline.execute()
+            await self.client.hset(self._meta_key(), 'vector_codec', codec.value)
+        self._configured_codec = codec
+        self._codec = codec
+        return migrated
 
     async def _hscan(
-        self, hash_key: bytes, cursor: Optional[int] = None, count: Optional[int] = None
-    ) -> Tuple[int, Iterable[Tuple[str, bytes]]]:
-        ids, outputs = [], []
-        pipeline = self.client.pipeline()
-        i = 1
+        self, fields: Tuple[bytes, ...], cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Iterable[Tuple[str, List[Optional[bytes]]]]]:
+        def fill(pipeline: Pipeline, ids: List[str]):
+            for _id in ids:
+                _ = pipeline.hmget(self._redis_key(_id), *fields)
+
+        cursor, batches = await self._scan_id_batches(cursor, count)
+        results = await self._pipelined(batches, fill)
+        return cursor, [(_id, output) for ids, outputs in results for _id, output in zip(ids, outputs)]
+
+    async def _scan_id_batches(
+        self, cursor: Optional[int], count: Optional[int]
+    ) -> Tuple[int, Union[Iterable[List[str]], AsyncIterable]]:
+        """Document ids in batches of `batch_size`, the whole index is scanned lazily if
+        `cursor` is None, else a single scan step is made."""
         if cursor is None:
-            cursor = 0
-            async for key in self.client.scan_iter(self._redis_match(), count):
-                _ = pipeline.hget(key, hash_key)
-                if i % self.batch_size == 0:
-                    outputs.extend(await pipeline.execute())
-                i += 1
-                ids.append(self._key_to_id(key.decode()))
-        else:
-            cursor, keys = await self.client.scan(cursor, self._redis_match(), count)
-            for key in keys:
-                _ = pipeline.hget(key, hash_key)
-                if i % self.batch_size == 0:
-                    outputs.extend(await pipeline.execute())
-                i += 1
-                ids.append(self._key_to_id(key.decode()))
-        outputs.extend(await pipeline.execute())
+            return 0, self._iter_id_batches(self.batch_size, count)
+        cursor, ids = await self._scan_step(cursor, count)
+        return cursor, chunks(ids, self.batch_size)
+
+    async def _scan_step(self, cursor: int, count: Optional[int]) -> Tuple[int, List[str]]:
+        await self._ensure_id_registry()
+        cursor, members = await self.client.sscan(self._ids_key(), cursor, count=count)
+        return cursor, [member.decode() for member in members]
+
+    async def _iter_id_batches(self, size: int, count: Optional[int] = None) -> AsyncIterator[List[str]]:
+        """Every registered document id, in batches of `size`. SSCAN returns every id
+        registered for the whole scan even while others are added or removed, but may
+        return an id twice."""
+        await self._ensure_id_registry()
+        batch = []
+        async for member in self.client.sscan_iter(self._ids_key(), count=count or size):
+            batch.append(member.decode())
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def _pipelined(
+        self,
+        batches: Union[Iterable[List[T]], AsyncIterable],
+        fill: Callable[[Pipeline, List[T]], None],
+        change_op: Optional[ChangeOp] = None,
+        batch_ids: Optional[Callable[[List[T]], List[str]]] = None,
+    ) -> List[Tuple[List[T], List[Any]]]:
+        """Send every batch in its own pipeline filled by `fill`, with up to
+        `pipeline_parallelism` pipelines in flight. Returns the batches with their outputs,
+        in order. Writes are logged as `change_op` of the `batch_ids` of each batch, whose
+        documents are invalidated once it's executed."""
+        semaphore = asyncio.Semaphore(self.pipeline_parallelism)
 
-        return cursor, zip(ids, outputs)
+        async def run(batch: List[T]) -> Tuple[List[T], List[Any]]:
+            try:
+                pipeline = self.client.pipeline(transaction=self.transactional_pipelines)
+                fill(pipeline, batch)
+                if change_op is None:
+                    outputs = await pipeline.execute()
+                else:
+                    ids = batch_ids(batch)
+                    outputs = await self._execute_logged(pipeline, change_op, ids)
+                    self.invalidate(ids)
+            finally:
+                semaphore.release()
+            return batch, outputs
+
+        tasks = []
+        try:
+            if isinstance(batches, AsyncIterable):
+                async for batch in batches:
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(run(batch)))
+            else:
+                for batch in batches:
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(run(batch)))
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def invalidate(self, ids: Iterable[str]):
+        """Drop documents from the document cache, e.g. after other replicas changed them."""
+        if self.document_cache is None:
+            return
+        self._invalidations += 1
+        for _id in ids:
+            self.document_cache.pop(_id)
+
+    def _cached_document(self, _id: str) -> Optional[Document]:
+        document = self.document_cache.get(_id) if self.document_cache is not None else None
+        if document is None:
+            return None
+        # callers get their own copy, so that they can't alter the cached metadata
+        return Document(page_content=document.page_content, metadata=dict(document.metadata))
+
+    def _cache_documents(self, documents: Dict[str, Document], invalidations: int):
+        if self.document_cache is None or invalidations != self._invalidations:
+            return
+        for _id, document in documents.items():
+            self.document_cache.put(_id, Document(page_content=document.page_content, metadata=dict(document.metadata)))
 
     async def search(self, _id: str) -> Document:
-        page_content = await self.get_content(_id)
-        metadata = await self.get_metadata(_id)
-        return Document(page_content=page_content, metadata=metadata)
+        cached = self._cached_document(_id)
+        if cached is not None:
+            return cached
+        invalidations = self._invalidations
+        content, content_marker, metadata, metadata_marker = await self.client.hmget(
+            self._redis_key(_id), *self._document_fields()
+        )
+        if content is None:
+            raise ValueError(f'no content for id: {_id}')
+        if metadata is None:
+            raise ValueError(f'no metadata for id: {_id}')
+        document = Document(
+            page_content=self._decode_content(content, content_marker),
+            metadata=self._decode_metadata(metadata, metadata_marker),
+        )
+        self._cache_documents({_id: document}, invalidations)
+        return document
 
-    async def add(self, datas: Dict[str, Tuple[str, List[float], Dict]]):
+    async def search_many(self, ids: Iterable[str]) -> Dict[str, Document]:
+        """Fetch content and metadata of many documents in a single pipelined pass.
+
+        Ids without a stored document are left out of the result, cached documents
+        are not fetched again.
+        """
+        documents = {}
+        missing = []
+        for _id in ids:
+            cached = self._cached_document(_id)
+            if cached is not None:
+                documents[_id] = cached
+            else:
+                missing.append(_id)
+        if not missing:
+            return documents
+
+        invalidations = self._invalidations
         pipeline = self.client.pipeline()
-        i = 1
-        for _id, (content, vector, metadata) in datas.items():
-            _ = pipeline.hset(
-                self._redis_key(_id),
-                mapping={
-                    self.content_key: content,
-                    self.vector_key: np.array(vector, dtype=np.float32).tobytes(),
-                    self.metadata_key: json.dumps(metadata),
-                },
-            )
-            if i % self.batch_size == 0:
-                await pipeline.execute()
-            i += 1
-        await pipeline.execute()
+        for _id in missing:
+            _ = pipeline.hmget(self._redis_key(_id), *self._document_fields())
+        outputs: List = await pipeline.execute()
+        fetched = {}
+        for _id, fields in zip(missing, outputs):
+            document = self._parse_document(fields)
+            if document is not None:
+                fetched[_id] = document
+        self._cache_documents(fetched, invalidations)
+        documents.update(fetched)
+        return documents
+
+    async def add(self, datas: Dict[str, Tuple[str, List[float], Dict]]):
+        codec = await self.vector_codec()
+
+        def fill(pipeline: Pipeline, batch: List[Tuple[str, Tuple[str, List[float], Dict]]]):
+            for _id, (content, vector, metadata) in batch:
+                digest = content_hash(content)
+                _ = pipeline.hset(
+                    self._redis_key(_id),
+                    mapping={
+                        **self._encode_content(content),
+                        self.vector_key: encode_vector(vector, codec),
+                        **self._encode_metadata(metadata),
+                        self.content_hash_key: digest,
+                    },
+                )
+                _ = pipeline.hset(self._content_hashes_key(), digest, _id)
+            _ = pipeline.sadd(self._ids_key(), *[_id for _id, _ in batch])
+
+        await self._pipelined(
+            chunks(list(datas.items()), self.batch_size),
+            fill,
+            ChangeOp.ADD,
+            lambda batch: [_id for _id, _ in batch],
+        )
 
     async def delete(self, ids: List[str]):
-        await self.client.delete(*[self._redis_key(_id) for _id in ids])
+        # drop the content hash entries still pointing at the deleted documents
+        hashes = await self.get_many_content_hashes(ids)
+        stale = []
+        if hashes:
+            owners = await self.client.hmget(self._content_hashes_key(), list(hashes.values()))
+            stale = [
+                digest
+                for (_id, digest), owner in zip(hashes.items(), owners)
+                if owner is not None and owner.decode() == _id
+            ]
+        pipeline = self.client.pipeline()
+        if self.cluster:
+            # documents are in different slots, a multi key delete would be rejected
+            for _id in ids:
+                _ = pipeline.delete(self._redis_key(_id))
+        else:
+            _ = pipeline.delete(*[self._redis_key(_id) for _id in ids])
+        if stale:
+            _ = pipeline.hdel(self._content_hashes_key(), *stale)
+        if ids:
+            _ = pipeline.srem(self._ids_key(), *ids)
+        await self._execute_logged(pipeline, ChangeOp.DELETE, ids)
+        self.invalidate(ids)
 
     async def get_content(self, _id: str) -> str:
-        content = await self.client.hget(self._redis_key(_id), self.content_key)
+        if self.document_cache is not None:
+            return (await self.search(_id)).page_content
+        content, marker = await self.client.hmget(self._redis_key(_id), self.content_key, self.content_codec_key)
         if content is not None:
-            # content is bytes, decode to str
-            return content.decode()
+            return self._decode_content(content, marker)
         else:
             raise ValueError(f'no content for id: {_id}')
 
     async def get_many_contents(self, ids: Iterable[str]) -> Dict[str, str]:
+        if self.document_cache is not None:
+            return {_id: document.page_content for _id, document in (await self.search_many(ids)).items()}
         pipeline = self.client.pipeline()
         for _id in ids:
-            _ = pipeline.hget(self._redis_key(_id), self.content_key)
+            _ = pipeline.hmget(self._redis_key(_id), self.content_key, self.content_codec_key)
         contents: List = await pipeline.execute()
-        return {_id: content.decode() for _id, content in zip(ids, contents) if content is not None}
+        return {
+            _id: self._decode_content(content, marker)
+            for _id, (content, marker) in zip(ids, contents)
+            if content is not None
+        }
 
     async def get_metadata(self, _id: str) -> Dict:
-        metadata = await self.client.hget(self._redis_key(_id), self.metadata_key)
+        if self.document_cache is not None:
+            return (await self.search(_id)).metadata
+        metadata, marker = await self.client.hmget(self._redis_key(_id), self.metadata_key, self.metadata_codec_key)
         if metadata is not None:
-            return json.loads(metadata)
+            return self._decode_metadata(metadata, marker)
         else:
             raise ValueError(f'no metadata for id: {_id}')
 
     async def get_many_metadatas(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        if self.document_cache is not None:
+            return {_id: document.metadata for _id, document in (await self.search_many(ids)).items()}
         pipeline = self.client.pipeline()
         for _id in ids:
-            _ = pipeline.hget(self._redis_key(_id), self.metadata_key)
+            _ = pipeline.hmget(self._redis_key(_id), self.metadata_key, self.metadata_codec_key)
         metadatas: List = await pipeline.execute()
-        return {_id: json.loads(metadata) for _id, metadata in zip(ids, metadatas) if metadata is not None}
+        return {
+            _id: self._decode_metadata(metadata, marker)
+            for _id, (metadata, marker) in zip(ids, metadatas)
+            if metadata is not None
+        }
+
+    async def get_many_content_hashes(self, ids: Iterable[str]) -> Dict[str, str]:
+        """Content hash of each document, documents stored without one are left out."""
+        ids = list(ids)
+        pipeline = self.client.pipeline()
+        for _id in ids:
+            _ = pipeline.hget(self._redis_key(_id), self.content_hash_key)
+        hashes: List = await pipeline.execute()
+        return {_id: digest.decode() for _id, digest in zip(ids, hashes) if digest is not None}
+
+    async def find_ids(self, ids: Iterable[str]) -> Set[str]:
+        """The ids among `ids` of stored documents, whether or not they have a content hash."""
+        ids = list(ids)
+        pipeline = self.client.pipeline()
+        for _id in ids:
+            _ = pipeline.hexists(self._redis_key(_id), self.content_key)
+        exists: List = await pipeline.execute()
+        return {_id for _id, stored in zip(ids, exists) if stored}
+
+    async def find_content_hashes(self, hashes: Iterable[str]) -> Dict[str, str]:
+        """Map content hashes to the id of a document currently holding that content."""
+        hashes = list(set(hashes))
+        if not hashes:
+            return {}
+        owners = await self.client.hmget(self._content_hashes_key(), hashes)
+        candidates = {digest: owner.decode() for digest, owner in zip(hashes, owners) if owner is not None}
+        # the owner may have been overwritten with other content since
+        current = await self.get_many_content_hashes(candidates.values())
+        return {digest: _id for digest, _id in candidates.items() if current.get(_id) == digest}
 
     async def get_vector(self, _id: str) -> List[float]:
+        codec = await self.vector_codec()
         vector = await self.client.hget(self._redis_key(_id), self.vector_key)
         if vector is not None:
-            return np.frombuffer(vector, dtype=np.float32).tolist()
+            return decode_vector(vector, codec).tolist()
         else:
             raise ValueError(f'no vector for id: {_id}')
 
@@ -138,79 +651,154 @@ class RedisStore:
         for _id in ids:
             _ = pipeline.hget(self._redis_key(_id), self.vector_key)
         vectors: List = await pipeline.execute()
-        return {_id: np.frombuffer(vector, dtype=np.float32).tolist()
+        codec = await self.vector_codec()
+        return {_id: decode_vector(vector, codec).tolist()
                 for _id, vector in zip(ids, vectors) if vector is not None}
 
     async def scan_ids(
         self, cursor: Optional[int] = None, count: Optional[int] = None
     ) -> Tuple[int, List[str]]:
         if cursor is None:
-            return 0, [self._key_to_id(key.decode())
-                       async for key in self.client.scan_iter(self._redis_match(), count)]
+            return 0, [_id async for ids in self._iter_id_batches(self.batch_size, count) for _id in ids]
         else:
-            cursor, keys = await self.client.scan(cursor, self._redis_match(), count)
-            return cursor, [self._key_to_id(key.decode()) for key in keys]
+            return await self._scan_step(cursor, count)
 
     async def scan_contents(
         self, cursor: Optional[int] = None, count: Optional[int] = None
     ) -> Tuple[int, Dict[str, str]]:
-        cursor, outputs = await self._hscan(self.content_key, cursor, count)
-        return cursor, {_id: content.decode() for _id, content in outputs}
+        cursor, outputs = await self._hscan((self.content_key, self.content_codec_key), cursor, count)
+        return cursor, {
+            _id: self._decode_content(content, marker) for _id, (content, marker) in outputs if content is not None
+        }
 
     async def scan_vectors(
         self, cursor: Optional[int] = None, count: Optional[int] = None
     ) -> Tuple[int, Dict[str, List[float]]]:
-        cursor, outputs = await self._hscan(self.vector_key, cursor, count)
-        return cursor, {_id: np.frombuffer(vec, dtype=np.float32).tolist() for _id, vec in outputs}
+        codec = await self.vector_codec()
+        cursor, outputs = await self._hscan((self.vector_key,), cursor, count)
+        return cursor, {_id: decode_vector(vec, codec).tolist() for _id, (vec,) in outputs if vec is not None}
+
+    async def iter_vector_pages(self, page_size: Optional[int] = None) -> AsyncIterator[VectorPage]:
+        """Scan the vectors and metadata of the index page by page.
+
+        Each page's vectors are decoded straight from the redis bytes into one float32
+        matrix, so only a page is held at a time rather than the whole corpus as lists.
+        Pages hold about `page_size` documents, defaulting to the batch size.
+        """
+        codec = await self.vector_codec()
+        async for batch in self._iter_id_batches(page_size or self.batch_size):
+            pipeline = self.client.pipeline()
+            for _id in batch:
+                _ = pipeline.hmget(self._redis_key(_id), self.vector_key, self.metadata_key, self.metadata_codec_key)
+            rows = await pipeline.execute()
+            ids, datas, metadatas = [], [], []
+            # scan may return an id twice, documents deleted meanwhile come back empty
+            for _id, (vector, metadata, marker) in dict(zip(batch, rows)).items():
+                if vector is None:
+                    continue
+                ids.append(_id)
+                datas.append(vector)
+                metadatas.append(self._decode_metadata(metadata, marker) if metadata is not None else {})
+            if ids:
+                yield VectorPage(ids, decode_vectors(datas, codec), metadatas)
 
     async def scan_metadatas(
         self, cursor: Optional[int] = None, count: Optional[int] = None
     ) -> Tuple[int, Dict[str, Dict]]:
-        cursor, outputs = await self._hscan(self.metadata_key, cursor, count)
-        return cursor, {_id: json.loads(metadata) for _id, metadata in outputs}
+        cursor, outputs = await self._hscan((self.metadata_key, self.metadata_codec_key), cursor, count)
+        return cursor, {
+            _id: self._decode_metadata(metadata, marker)
+            for _id, (metadata, marker) in outputs
+            if metadata is not None
+        }
 
     async def scan_all(
         self,
         cursor: Optional[int] = None,
         count: Optional[int] = None,
     ) -> Tuple[int, Dict[str, Tuple[str, List[float], Dict]]]:
-        ids = []
-        outputs = []
-        pipeline = self.client.pipeline()
-        i = 1
-        if cursor is None:
-            cursor = 0
-            async for key in self.client.scan_iter(self._redis_match(), count):
-                _ = pipeline.hgetall(key)
-                if i % self.batch_size == 0:
-                    outputs.extend(await pipeline.execute())
-                i += 1
-                ids.append(self._key_to_id(key.decode()))
-        else:
-            cursor, keys = await self.client.scan(cursor, self._redis_match(), count)
-            for key in keys:
-                _ = pipeline.hgetall(key)
-                if i % self.batch_size == 0:
-                    outputs.extend(await pipeline.execute())
-                i += 1
-                ids.append(self._key_to_id(key.decode()))
-        outputs.extend(await pipeline.execute())
+        def fill(pipeline: Pipeline, ids: List[str]):
+            for _id in ids:
+                _ = pipeline.hgetall(self._redis_key(_id))
+
+        cursor, batches = await self._scan_id_batches(cursor, count)
+        results = await self._pipelined(batches, fill)
+        codec = await self.vector_codec()
 
         def _parse(data: Dict) -> Tuple[str, List[float], Dict]:
             return (
-                data[self.content_key].decode(),
-                np.frombuffer(data[self.vector_key], dtype=np.float32).tolist(),
-                json.loads(data[self.metadata_key]),
+                self._decode_content(data[self.content_key], data.get(self.content_codec_key)),
+                decode_vector(data[self.vector_key], codec).tolist(),
+                self._decode_metadata(data[self.metadata_key], data.get(self.metadata_codec_key)),
             )
-        return cursor, {_id: _parse(data) for _id, data in zip(ids, outputs)}
+        return cursor, {
+            _id: _parse(data)
+            for ids, outputs in results
+            for _id, data in zip(ids, outputs)
+            if data
+        }
 
     # only metadata can be updated
     async def update_metadatas(self, metadatas: Dict[str, Dict]):
-        pipeline = self.client.pipeline()
-        i = 1
-        for _id, metadata in metadatas.items():
-            _ = pipeline.hset(self._redis_key(_id), self.metadata_key, json.dumps(metadata))
-            if i % self.batch_size == 0:
+        def fill(pipeline: Pipeline, batch: List[Tuple[str, Dict]]):
+            for _id, metadata in batch:
+                _ = pipeline.hset(self._redis_key(_id), mapping=self._encode_metadata(metadata))
+
+        await self._pipelined(
+            chunks(list(metadatas.items()), self.batch_size),
+            fill,
+            ChangeOp.UPDATE,
+            lambda batch: [_id for _id, _ in batch],
+        )
+
+    async def drop(self):
+        """Delete every key of the index, leaving the rest of the database alone."""
+        keys = [self._ids_key(), self._content_hashes_key(), self._meta_key(), self._changelog_key()]
+        async for key in self._scan_keyspace(self.batch_size):
+            keys.append(key)
+        for batch in chunks(keys, self.batch_size):
+            if self.cluster:
+                # keys are in different slots, a multi key delete would be rejected
+                pipeline = self.client.pipeline(transaction=False)
+                for key in batch:
+                    _ = pipeline.delete(key)
                 await pipeline.execute()
-            i += 1
-        await pipeline.execute()
+            else:
+                await self.client.delete(*batch)
+        self._codec = None
+        self._id_registry_ready = False
+        self._invalidations += 1
+        if self.document_cache is not None:
+            self.document_cache.clear()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def last_change_id(self) -> str:
+        """Id of the latest change, `0-0` if nothing was logged yet."""
+        entries = await self.client.xrevrange(self._changelog_key(), count=1)
+        return entries[0][0].decode() if entries else '0-0'
+
+    async def first_change_id(self) -> Optional[str]:
+        """Id of the oldest change still kept in the trimmed change stream."""
+        entries = await self.client.xrange(self._changelog_key(), count=1)
+        return entries[0][0].decode() if entries else None
+
+    @staticmethod
+    def _parse_change(change_id: bytes, fields: Dict[bytes, bytes]) -> Change:
+        return Change(
+            change_id=change_id.decode(),
+            op=ChangeOp(fields[b'op'].decode()),
+            ids=json.loads(fields[b'ids']),
+            origin=fields[b'origin'].decode(),
+        )
+
+    async def read_changes(self, after: str, count: Optional[int] = None) -> List[Change]:
+        """Read the changes logged after the change id `after`, oldest first."""
+        entries = await self.client.xrange(self._changelog_key(), min=f'({after}', count=count)
+        return [self._parse_change(change_id, fields) for change_id, fields in entries]
+
+    async def wait_changes(self, after: str, block: int, count: Optional[int] = None) -> List[Change]:
+        """Like `read_changes`, but blocks up to `block` milliseconds until a change is logged."""
+        streams = await self.client.xread({self._changelog_key(): after}, count=count, block=block)
+        return [self._parse_change(change_id, fields) for _, entries in streams or [] for change_id, fields in entries]
@@ -0,0 +1,141 @@
+import hashlib
+import numpy as np
+
+from enum import Enum
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, NamedTuple, Optional, Protocol, Tuple, TypeVar
+from langchain.schema.document import Document
+
+
+class ChangeOp(str, Enum):
+    ADD = 'add'
+    DELETE = 'delete'
+    UPDATE = 'update'
+
+
+class Change(NamedTuple):
+    change_id: str
+    op: ChangeOp
+    ids: List[str]
+    origin: str
+    """replica_id of the store which made the change"""
+
+
+class VectorPage(NamedTuple):
+    ids: List[str]
+    vectors: np.ndarray
+    """float32 matrix, one row per id"""
+    metadatas: List[Dict]
+
+
+T = TypeVar('T')
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def chunks(items: List[T], size: int) -> Iterator[List[T]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class DocStore(Protocol):
+    """Document store a FaissSearcher indexes, see RedisStore and SqliteStore.
+
+    Documents are a content, a vector and a metadata stored by id. Every write is logged
+    as a change, so that searchers of other replicas can catch up with it. Change ids
+    are `<int>-<int>` strings ordered as int pairs, `0-0` before any change.
+
+    Scans take a cursor, None to scan everything at once, and return the cursor to
+    continue from, 0 once done.
+    """
+
+    batch_size: int
+    replica_id: str
+
+    def invalidate(self, ids: Iterable[str]):
+        """Drop documents from any in-process cache, e.g. after other replicas changed them."""
+        ...
+
+    async def search(self, _id: str) -> Document:
+        ...
+
+    async def search_many(self, ids: Iterable[str]) -> Dict[str, Document]:
+        ...
+
+    async def add(self, datas: Dict[str, Tuple[str, List[float], Dict]]):
+        ...
+
+    async def delete(self, ids: List[str]):
+        ...
+
+    async def update_metadatas(self, metadatas: Dict[str, Dict]):
+        ...
+
+    async def get_content(self, _id: str) -> str:
+        ...
+
+    async def get_many_contents(self, ids: Iterable[str]) -> Dict[str, str]:
+        ...
+
+    async def get_metadata(self, _id: str) -> Dict:
+        ...
+
+    async def get_many_metadatas(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        ...
+
+    async def get_vector(self, _id: str) -> List[float]:
+        ...
+
+    async def get_many_vectors(self, ids: Iterable[str]) -> Dict[str, List[float]]:
+        ...
+
+    async def get_many_content_hashes(self, ids: Iterable[str]) -> Dict[str, str]:
+        ...
+
+    async def find_content_hashes(self, hashes: Iterable[str]) -> Dict[str, str]:
+        """Id of a document currently holding each content hash, unknown hashes are left out."""
+        ...
+
+    async def scan_ids(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, List[str]]:
+        ...
+
+    async def scan_contents(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, str]]:
+        ...
+
+    async def scan_vectors(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, List[float]]]:
+        ...
+
+    async def scan_metadatas(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, Dict]]:
+        ...
+
+    async def scan_all(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, Tuple[str, List[float], Dict]]]:
+        ...
+
+    def iter_vector_pages(self, page_size: Optional[int] = None) -> AsyncIterator[VectorPage]:
+        ...
+
+    async def last_change_id(self) -> str:
+        ...
+
+    async def first_change_id(self) -> Optional[str]:
+        ...
+
+    async def read_changes(self, after: str, count: Optional[int] = None) -> List[Change]:
+        ...
+
+    async def wait_changes(self, after: str, block: int, count: Optional[int] = None) -> List[Change]:
+        ...
+
+    async def aclose(self) -> Any:
+        ...
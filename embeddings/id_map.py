@@ -0,0 +1,82 @@
+import numpy as np
+
+from typing import Optional, Dict, List, Iterable, Iterator, Tuple
+
+
+class DocIdMap:
+    """Mapping between stable int64 index keys and docstore ids.
+
+    Keys are handed out in increasing order and never reused, so key -> id is a plain
+    array indexed by key, with None for keys whose document was removed.
+    """
+
+    _ids: List[Optional[str]]
+    _keys: Dict[str, int]
+
+    def __init__(self):
+        self._ids = []
+        self._keys = {}
+
+    @classmethod
+    def from_items(cls, keys: Iterable[int], ids: Iterable[str], next_key: int) -> "DocIdMap":
+        id_map = cls()
+        id_map._ids = [None] * next_key
+        for key, _id in zip(keys, ids):
+            id_map._ids[key] = _id
+            id_map._keys[_id] = key
+        return id_map
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: int) -> bool:
+        # also false for the -1 faiss returns when not enough docs are found
+        return 0 <= key < len(self._ids) and self._ids[key] is not None
+
+    def __getitem__(self, key: int) -> str:
+        _id = self._ids[key] if 0 <= key < len(self._ids) else None
+        if _id is None:
+            raise KeyError(key)
+        return _id
+
+    def get(self, key: int, default: Optional[str] = None) -> Optional[str]:
+        return self[key] if key in self else default
+
+    @property
+    def next_key(self) -> int:
+        return len(self._ids)
+
+    def has_id(self, _id: str) -> bool:
+        return _id in self._keys
+
+    def key_of(self, _id: str) -> int:
+        return self._keys[_id]
+
+    def keys_of(self, ids: Iterable[str]) -> np.ndarray:
+        return np.array([self._keys[_id] for _id in ids], dtype=np.int64)
+
+    def add(self, ids: List[str]) -> np.ndarray:
+        """Assign fresh keys to ids, which must not be mapped yet."""
+        start = len(self._ids)
+        self._ids.extend(ids)
+        for offset, _id in enumerate(ids):
+            self._keys[_id] = start + offset
+        return np.arange(start, len(self._ids), dtype=np.int64)
+
+    def remove(self, ids: Iterable[str]) -> np.ndarray:
+        """Unmap ids and return their keys."""
+        keys = []
+        for _id in ids:
+            key = self._keys.pop(_id)
+            self._ids[key] = None
+            keys.append(key)
+        return np.array(keys, dtype=np.int64)
+
+    def keys(self) -> Iterator[int]:
+        return iter(self._keys.values())
+
+    def values(self) -> Iterator[str]:
+        return iter(self._keys.keys())
+
+    def items(self) -> Iterator[Tuple[int, str]]:
+        return ((key, _id) for _id, key in self._keys.items())
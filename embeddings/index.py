@@ -0,0 +1,351 @@
+import time
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Dict, List, Iterable, Optional, Tuple
+from pydantic import BaseModel
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+
+class IndexKind(str, Enum):
+    FLAT = 'flat'
+    IVF_FLAT = 'ivf_flat'
+    IVF_PQ = 'ivf_pq'
+    HNSW = 'hnsw'
+    SQ = 'sq'
+
+
+class IndexSpec(BaseModel):
+    """Describes the ann index a FaissSearcher trains once its corpus is large enough."""
+
+    kind: IndexKind = IndexKind.FLAT
+    train_threshold: int = 10_000
+    """corpus size from which the trained index replaces the flat one"""
+    nlist: int = 1024
+    """number of inverted lists (ivf_flat, ivf_pq)"""
+    nprobe: int = 16
+    """number of inverted lists visited at search time (ivf_flat, ivf_pq)"""
+    pq_m: int = 16
+    """number of sub-quantizers, must divide the embedding dim (ivf_pq)"""
+    pq_nbits: int = 8
+    """bits per sub-quantizer code (ivf_pq)"""
+    hnsw_m: int = 32
+    """number of neighbors per graph node (hnsw)"""
+    ef_construction: int = 200
+    """candidate list size at build time (hnsw)"""
+    ef_search: int = 64
+    """candidate list size at search time (hnsw)"""
+    sq_type: str = 'QT_8bit'
+    """faiss ScalarQuantizer type name (sq)"""
+
+
+class IndexEvaluation(BaseModel):
+    params: Dict[str, int]
+    recall: float
+    """fraction of the exact top-k found by the evaluated index"""
+    latency_ms: float
+    """average search latency per query in milliseconds"""
+
+
+def _metric(distance_strategy: DistanceStrategy) -> int:
+    faiss = dependable_faiss_import()
+    if distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        return faiss.METRIC_INNER_PRODUCT
+    else:
+        # Default to L2, currently other metric types not initialized.
+        return faiss.METRIC_L2
+
+
+def create_flat_index(embedding_dim: int, distance_strategy: DistanceStrategy) -> Any:
+    faiss = dependable_faiss_import()
+    if distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        return faiss.IndexFlatIP(embedding_dim)
+    else:
+        return faiss.IndexFlatL2(embedding_dim)
+
+
+class ShardedIndex:
+    """Flat IDMap2 sub-indexes partitioned by key, searched in parallel with one thread per shard.
+
+    Keys are assigned sequentially and never reused, so `key % num_shards` spreads them
+    evenly and routes adds, removals and reconstructions without any lookup. Exposes the
+    subset of the faiss index api FaissSearcher uses.
+    """
+
+    shards: List[Any]
+    distance_strategy: DistanceStrategy
+    _parallel: Any
+    # runs the shards of searches with search parameters, one thread per shard
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, embedding_dim: int, distance_strategy: DistanceStrategy, num_shards: int):
+        faiss = dependable_faiss_import()
+        self.distance_strategy = distance_strategy
+        self.shards = [
+            faiss.IndexIDMap2(create_flat_index(embedding_dim, distance_strategy)) for _ in range(num_shards)
+        ]
+        # searches every shard in its own thread and merges their top-k, keys are left as they are
+        self._parallel = faiss.IndexShards(embedding_dim, True, False)
+        for shard in self.shards:
+            self._parallel.add_shard(shard)
+        self._executor = ThreadPoolExecutor(num_shards, thread_name_prefix='faiss-shard')
+
+    @classmethod
+    def from_index(
+        cls, index: Any, distance_strategy: DistanceStrategy, num_shards: int
+    ) -> "ShardedIndex":
+        """Partition the vectors of an IDMap index into a new sharded index."""
+        sharded = cls(index.d, distance_strategy, num_shards)
+        if index.ntotal > 0:
+            keys, vectors = export_vectors(index)
+            sharded.add_with_ids(vectors, keys)
+        return sharded
+
+    @property
+    def d(self) -> int:
+        return self._parallel.d
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.ntotal for shard in self.shards)
+
+    def _route(self, keys: np.ndarray) -> np.ndarray:
+        return keys % len(self.shards)
+
+    def add_with_ids(self, vectors: np.ndarray, keys: np.ndarray):
+        keys = np.asarray(keys, dtype=np.int64)
+        owners = self._route(keys)
+        for i, shard in enumerate(self.shards):
+            mask = owners == i
+            if mask.any():
+                shard.add_with_ids(np.ascontiguousarray(vectors[mask]), keys[mask])
+        self._parallel.syncWithSubIndexes()
+
+    def remove_ids(self, keys: np.ndarray) -> int:
+        keys = np.asarray(keys, dtype=np.int64)
+        owners = self._route(keys)
+        removed = sum(
+            shard.remove_ids(keys[owners == i]) for i, shard in enumerate(self.shards) if (owners == i).any()
+        )
+        self._parallel.syncWithSubIndexes()
+        return removed
+
+    def reconstruct_batch(self, keys: np.ndarray) -> np.ndarray:
+        keys = np.asarray(keys, dtype=np.int64)
+        owners = self._route(keys)
+        vectors = np.empty((len(keys), self.d), dtype=np.float32)
+        for i, shard in enumerate(self.shards):
+            mask = owners == i
+            if mask.any():
+                vectors[mask] = shard.reconstruct_batch(keys[mask])
+        return vectors
+
+    def _shard_params(self, params: Any) -> List[Any]:
+        """A copy of `params` per shard: IDMap searches swap the selector of their params
+        in place, so shards searched at once can't share them."""
+        faiss = dependable_faiss_import()
+        return [faiss.SearchParameters(sel=params.sel) for _ in self.shards]
+
+    def search(self, vectors: np.ndarray, k: int, params: Any = None) -> Tuple[np.ndarray, np.ndarray]:
+        if params is None:
+            return self._parallel.search(vectors, k)
+        results = list(self._executor.map(
+            lambda shard, shard_params: shard.search(vectors, k, params=shard_params),
+            self.shards,
+            self._shard_params(params),
+        ))
+        scores = np.concatenate([shard_scores for shard_scores, _ in results], axis=1)
+        keys = np.concatenate([shard_keys for _, shard_keys in results], axis=1)
+        # missing hits are keyed -1, they sort after every real hit
+        ranks = -scores if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT else scores
+        order = np.argsort(np.where(keys < 0, np.inf, ranks), axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(keys, order, axis=1)
+
+    def range_search(
+        self, vectors: np.ndarray, radius: float, params: Any = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # IndexShards has no range search, the shards are searched one after the other
+        shard_params = self._shard_params(params) if params is not None else [None] * len(self.shards)
+        results = [
+            shard.range_search(vectors, radius, params=sp) for shard, sp in zip(self.shards, shard_params)
+        ]
+        lims = np.zeros(len(vectors) + 1, dtype=np.int64)
+        scores, keys = [], []
+        for i in range(len(vectors)):
+            for shard_lims, shard_scores, shard_keys in results:
+                scores.append(shard_scores[shard_lims[i]:shard_lims[i + 1]])
+                keys.append(shard_keys[shard_lims[i]:shard_lims[i + 1]])
+            lims[i + 1] = lims[i] + sum(shard_lims[i + 1] - shard_lims[i] for shard_lims, _, _ in results)
+        return lims, np.concatenate(scores), np.concatenate(keys)
+
+    def merged(self) -> Any:
+        """A single IDMap2 index holding the vectors of every shard, e.g. to serialize it."""
+        faiss = dependable_faiss_import()
+        index = faiss.IndexIDMap2(create_flat_index(self.d, self.distance_strategy))
+        for shard in self.shards:
+            if shard.ntotal > 0:
+                keys, vectors = export_vectors(shard)
+                index.add_with_ids(vectors, keys)
+        return index
+
+
+def rank_range_results(
+    lims: np.ndarray,
+    scores: np.ndarray,
+    keys: np.ndarray,
+    k: Optional[int],
+    distance_strategy: DistanceStrategy,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Turn unordered range search results into `search` shaped results: the best `k` hits
+    per query, or all of them if `k` is None, padded with nan scores and -1 keys."""
+    counts = np.diff(lims)
+    width = int(counts.max(initial=0)) if k is None else min(k, int(counts.max(initial=0)))
+    ranked_scores = np.full((len(counts), width), np.nan, dtype=np.float32)
+    ranked_keys = np.full((len(counts), width), -1, dtype=np.int64)
+    for i, (start, end) in enumerate(zip(lims[:-1], lims[1:])):
+        row = scores[start:end]
+        order = np.argsort(-row if distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT else row, kind='stable')
+        order = order[:width]
+        ranked_scores[i, :len(order)] = row[order]
+        ranked_keys[i, :len(order)] = keys[start:end][order]
+    return ranked_scores, ranked_keys
+
+
+def supports_removal(index: Any) -> bool:
+    faiss = dependable_faiss_import()
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return not isinstance(index, faiss.IndexHNSW)
+
+
+def export_vectors(index: Any, start: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Return keys and vectors stored in an IDMap index, from insertion position `start` on."""
+    faiss = dependable_faiss_import()
+    keys = faiss.vector_to_array(index.id_map)[start:].astype(np.int64)
+    vectors = faiss.downcast_index(index.index).reconstruct_n(start, index.ntotal - start)
+    return keys, vectors
+
+
+def set_search_params(index: Any, params: Dict[str, int]):
+    faiss = dependable_faiss_import()
+    space = faiss.ParameterSpace()
+    for name, value in params.items():
+        space.set_index_parameter(index, name, value)
+
+
+def selector_search_params(index: Any, selector: Any) -> Any:
+    """Search parameters restricting `index.search` to the keys accepted by `selector`."""
+    faiss = dependable_faiss_import()
+    if isinstance(index, ShardedIndex):
+        # shards are flat, the parameters are passed on to each of them
+        return faiss.SearchParameters(sel=selector)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # ivf indexes only accept their own parameter type, which also overrides nprobe
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    else:
+        return faiss.SearchParameters(sel=selector)
+
+
+def per_search_params(index: Any, params: Dict[str, int]) -> Any:
+    """Search parameters applying `params` to a single `index.search`, leaving the index untouched."""
+    faiss = dependable_faiss_import()
+    unknown = set(params).difference({'nprobe', 'efSearch'})
+    if unknown:
+        raise ValueError(f'unsupported search params: {unknown}')
+    if 'nprobe' in params:
+        if faiss.try_extract_index_ivf(index) is None:
+            raise ValueError('nprobe only applies to ivf indexes')
+        return faiss.SearchParametersIVF(nprobe=params['nprobe'])
+    if 'efSearch' in params:
+        return faiss.SearchParametersHNSW(efSearch=params['efSearch'])
+    return None
+
+
+def search_params(spec: IndexSpec) -> Dict[str, int]:
+    if spec.kind in (IndexKind.IVF_FLAT, IndexKind.IVF_PQ):
+        return {'nprobe': spec.nprobe}
+    elif spec.kind == IndexKind.HNSW:
+        return {'efSearch': spec.ef_search}
+    else:
+        return {}
+
+
+def train_index(
+    spec: IndexSpec,
+    embedding_dim: int,
+    distance_strategy: DistanceStrategy,
+    vectors: np.ndarray,
+    ids: np.ndarray,
+) -> Any:
+    """Build the index described by `spec`, train it on `vectors` and add them under `ids`.
+
+    This is CPU heavy and blocking, callers on the event loop should run it in a thread.
+    """
+    faiss = dependable_faiss_import()
+    metric = _metric(distance_strategy)
+    # faiss needs at least 39 training points per centroid
+    nlist = max(1, min(spec.nlist, len(vectors) // 39))
+    if spec.kind == IndexKind.FLAT:
+        index = faiss.IndexIDMap2(create_flat_index(embedding_dim, distance_strategy))
+    elif spec.kind == IndexKind.IVF_FLAT:
+        quantizer = create_flat_index(embedding_dim, distance_strategy)
+        index = faiss.IndexIVFFlat(quantizer, embedding_dim, nlist, metric)
+    elif spec.kind == IndexKind.IVF_PQ:
+        if embedding_dim % spec.pq_m != 0:
+            raise ValueError(f'pq_m {spec.pq_m} must divide embedding dim {embedding_dim}')
+        quantizer = create_flat_index(embedding_dim, distance_strategy)
+        index = faiss.IndexIVFPQ(quantizer, embedding_dim, nlist, spec.pq_m, spec.pq_nbits, metric)
+    elif spec.kind == IndexKind.HNSW:
+        hnsw = faiss.IndexHNSWFlat(embedding_dim, spec.hnsw_m, metric)
+        hnsw.hnsw.efConstruction = spec.ef_construction
+        index = faiss.IndexIDMap2(hnsw)
+    elif spec.kind == IndexKind.SQ:
+        qtype = getattr(faiss.ScalarQuantizer, spec.sq_type)
+        index = faiss.IndexIDMap2(faiss.IndexScalarQuantizer(embedding_dim, qtype, metric))
+    else:
+        raise ValueError(f'unknown index kind: {spec.kind}')
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if not index.is_trained:
+        index.train(vectors)
+    if isinstance(index, faiss.IndexIVF):
+        # lets reconstruct and remove_ids work with arbitrary ids
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    index.add_with_ids(vectors, ids.astype(np.int64))
+    set_search_params(index, search_params(spec))
+    return index
+
+
+def evaluate_index(
+    index: Any,
+    exact_index: Any,
+    queries: np.ndarray,
+    k: int,
+    params_grid: Iterable[Dict[str, int]],
+) -> List[IndexEvaluation]:
+    """Report recall@k and per query latency of `index` against `exact_index` for every params setting.
+
+    The settings are passed to each search, `index` itself is only read.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    _, expected = exact_index.search(queries, k)
+    evaluations = []
+    for params in params_grid:
+        per_search = per_search_params(index, params)
+        start = time.perf_counter()
+        _, found = index.search(queries, k, params=per_search)
+        elapsed = time.perf_counter() - start
+        hits = sum(
+            len(set(row[row != -1]).intersection(exact_row[exact_row != -1]))
+            for row, exact_row in zip(found, expected)
+        )
+        total = int((expected != -1).sum())
+        evaluations.append(IndexEvaluation(
+            params=params,
+            recall=hits / total if total > 0 else 1.0,
+            latency_ms=elapsed * 1000 / len(queries),
+        ))
+    return evaluations
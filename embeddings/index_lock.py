@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, Optional
+
+
+class IndexLock:
+    """Readers/writer lock between index searches and index mutations.
+
+    Searches run on pool threads and share the read side, so any number of them run at
+    once. Mutations run on the event loop, one at a time: the writer stops new searches
+    from starting and awaits the running ones without blocking the loop. The index is
+    then mutated synchronously, so reads made on the loop itself need no locking.
+    """
+
+    _cond: threading.Condition
+    _readers: int
+    _writing: bool
+    # resolved by the last reader leaving while the writer waits
+    _drained: Optional[asyncio.Future]
+    _writer: asyncio.Lock
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._drained = None
+        self._writer = asyncio.Lock()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """Blocking, for pool threads only."""
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                drained = self._drained if self._readers == 0 else None
+            if drained is not None:
+                drained.get_loop().call_soon_threadsafe(_resolve, drained)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[None]:
+        """For the event loop, nothing should be awaited while it's held."""
+        async with self._writer:
+            drained = None
+            with self._cond:
+                self._writing = True
+                if self._readers > 0:
+                    drained = self._drained = asyncio.get_running_loop().create_future()
+            try:
+                if drained is not None:
+                    await drained
+                yield
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._drained = None
+                    self._cond.notify_all()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from pathlib import Path
+from typing import Any, Optional, Dict, List, AsyncIterable, NamedTuple, Tuple
+from pydantic import BaseModel
+from langchain.text_splitter import TextSplitter
+
+from embeddings.docstore_base import content_hash
+from embeddings.searcher import FaissSearcher
+
+logger = logging.getLogger(__name__)
+
+
+class IngestConfig(BaseModel):
+    batch_size: int = 64
+    """chunks per embedding request"""
+    embed_concurrency: int = 4
+    """embedding requests in flight"""
+    queue_size: int = 8
+    """batches buffered between two stages, bounds the memory of the pipeline"""
+    checkpoint_path: Optional[Path] = None
+    """file recording how many input items were written, a rerun resumes after them"""
+    log_interval: float = 10.0
+    """seconds between two progress logs"""
+
+
+class IngestStats(BaseModel):
+    items: int = 0
+    """input items written by this run"""
+    chunks: int = 0
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+    elapsed: float = 0.0
+    """seconds"""
+
+    @property
+    def items_per_sec(self) -> float:
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class _Batch(NamedTuple):
+    seq: int
+    texts: List[str]
+    metadatas: List[Dict]
+    consumed: int
+    """input items whose chunks are all in this or an earlier batch"""
+
+
+class IngestPipeline:
+    """Streams (text, metadata) items into a FaissSearcher through chunk -> embed -> write stages.
+
+    Stages are connected by bounded queues so memory stays flat however large the input is.
+    Several batches are embedded concurrently, content already in the docstore is not embedded
+    again, and a single writer upserts the batches. The checkpoint only advances once every
+    earlier batch was written, so a failed run can be resumed without losing or skipping items.
+    """
+
+    searcher: FaissSearcher
+    config: IngestConfig
+    text_splitter: Optional[TextSplitter]
+    stats: IngestStats
+
+    def __init__(
+        self,
+        searcher: FaissSearcher,
+        config: Optional[IngestConfig] = None,
+        text_splitter: Optional[TextSplitter] = None,
+    ):
+        self.searcher = searcher
+        self.config = config or IngestConfig()
+        self.text_splitter = text_splitter
+        self.stats = IngestStats()
+
+    def _read_checkpoint(self) -> int:
+        path = self.config.checkpoint_path
+        if path is None or not path.exists():
+            return 0
+        return json.loads(path.read_text())['consumed']
+
+    def _write_checkpoint(self, consumed: int):
+        path = self.config.checkpoint_path
+        if path is None:
+            return
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(json.dumps({'consumed': consumed}))
+        os.replace(tmp, path)
+
+    def _split(self, text: str) -> List[str]:
+        if self.text_splitter is None:
+            return [text]
+        return self.text_splitter.split_text(text)
+
+    async def run(self, items: AsyncIterable[Tuple[str, Dict]]) -> IngestStats:
+        """Ingest `items`, skipping the ones a previous run with the same checkpoint already wrote."""
+        self.stats = IngestStats()
+        start = self._read_checkpoint()
+        if start > 0:
+            logger.info('resuming ingestion after %d items', start)
+        embed_queue: asyncio.Queue = asyncio.Queue(self.config.queue_size)
+        write_queue: asyncio.Queue = asyncio.Queue(self.config.queue_size)
+        stages = [asyncio.create_task(self._chunk(items, start, embed_queue))]
+        stages.extend(
+            asyncio.create_task(self._embed(embed_queue, write_queue))
+            for _ in range(self.config.embed_concurrency)
+        )
+        writer = asyncio.create_task(self._write(write_queue, start))
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*stages, writer)
+        except BaseException:
+            for task in stages:
+                task.cancel()
+            if not writer.done():
+                # let the writer finish the batches embedded so far rather than
+                # cancelling it halfway through writing the index and the docstore
+                for _ in range(self.config.embed_concurrency):
+                    # a full queue never drains if the writer fails meanwhile
+                    put = asyncio.ensure_future(write_queue.put(None))
+                    await asyncio.wait([put, writer], return_when=asyncio.FIRST_COMPLETED)
+                    if not put.done():
+                        put.cancel()
+                        break
+                await asyncio.wait([writer])
+            raise
+        finally:
+            self.stats.elapsed = time.perf_counter() - started
+        logger.info(
+            'ingested %d items (%d chunks) in %.1fs, %.1f items/s: %d inserted, %d updated, %d skipped',
+            self.stats.items, self.stats.chunks, self.stats.elapsed, self.stats.items_per_sec,
+            self.stats.inserted, self.stats.updated, self.stats.skipped,
+        )
+        return self.stats
+
+    async def _chunk(self, items: AsyncIterable[Tuple[str, Dict]], start: int, embed_queue: asyncio.Queue):
+        seq = 0
+        position = 0
+        flushed = start
+        texts: List[str] = []
+        metadatas: List[Dict] = []
+        async for text, metadata in items:
+            position += 1
+            if position <= start:
+                continue
+            for chunk in self._split(text):
+                texts.append(chunk)
+                metadatas.append(dict(metadata))
+            if len(texts) >= self.config.batch_size:
+                await embed_queue.put(_Batch(seq, texts, metadatas, position))
+                seq += 1
+                flushed = position
+                texts, metadatas = [], []
+        if position > flushed:
+            # an empty batch still moves the checkpoint past trailing items without any chunk
+            await embed_queue.put(_Batch(seq, texts, metadatas, position))
+        for _ in range(self.config.embed_concurrency):
+            await embed_queue.put(None)
+
+    async def _embed(self, embed_queue: asyncio.Queue, write_queue: asyncio.Queue):
+        while (batch := await embed_queue.get()) is not None:
+            to_embed: Dict[str, str] = {}
+            if batch.texts:
+                hashes = [content_hash(text) for text in batch.texts]
+                stored = await self.searcher.docstore.find_content_hashes(hashes)
+                to_embed = {digest: text for digest, text in zip(hashes, batch.texts) if digest not in stored}
+            vectors: Dict[str, List[float]] = {}
+            if to_embed:
+                embeddings = await self.searcher.embeddings.aembed_documents(list(to_embed.values()))
+                vectors = dict(zip(to_embed.keys(), embeddings))
+            await write_queue.put((batch, vectors))
+        await write_queue.put(None)
+
+    async def _write(self, write_queue: asyncio.Queue, start: int):
+        finished = 0
+        next_seq = 0
+        # consumed counts of written batches waiting for an earlier batch to be written
+        written: Dict[int, int] = {}
+        consumed = start
+        last_log = time.perf_counter()
+        while finished < self.config.embed_concurrency:
+            item: Any = await write_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            batch, vectors = item
+            if batch.texts:
+                report = await self.searcher.aupsert_texts(batch.texts, batch.metadatas, vectors=vectors)
+                self.stats.chunks += len(batch.texts)
+                self.stats.inserted += report.inserted
+                self.stats.updated += report.updated
+                self.stats.skipped += report.skipped
+
+            written[batch.seq] = batch.consumed
+            if next_seq in written:
+                while next_seq in written:
+                    consumed = written.pop(next_seq)
+                    next_seq += 1
+                self._write_checkpoint(consumed)
+                self.stats.items = consumed - start
+
+            now = time.perf_counter()
+            if now - last_log >= self.config.log_interval:
+                last_log = now
+                logger.info('ingested %d items, %d chunks so far', self.stats.items, self.stats.chunks)
@@ -0,0 +1,80 @@
+import heapq
+import math
+import re
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, token symbols and 0x addresses are kept whole."""
+    return _TOKEN.findall(text.lower())
+
+
+class LexicalIndex:
+    """In-memory inverted index scoring documents with Okapi BM25."""
+
+    k1: float
+    b: float
+    _postings: Dict[str, Dict[str, int]]
+    """term -> document id -> term frequency"""
+    _terms: Dict[str, List[str]]
+    """document id -> its distinct terms, to find its postings on removal"""
+    _lengths: Dict[str, int]
+    _total_length: int
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._terms = {}
+        self._lengths = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, texts: Dict[str, str]):
+        """Add documents, replacing the ones already indexed."""
+        self.remove(_id for _id in texts if _id in self._lengths)
+        for _id, text in texts.items():
+            tokens = tokenize(text)
+            frequencies = Counter(tokens)
+            for term, frequency in frequencies.items():
+                self._postings.setdefault(term, {})[_id] = frequency
+            self._terms[_id] = list(frequencies)
+            self._lengths[_id] = len(tokens)
+            self._total_length += len(tokens)
+
+    def remove(self, ids: Iterable[str]):
+        for _id in list(ids):
+            length = self._lengths.pop(_id, None)
+            if length is None:
+                continue
+            self._total_length -= length
+            for term in self._terms.pop(_id, ()):
+                postings = self._postings[term]
+                del postings[_id]
+                if not postings:
+                    del self._postings[term]
+
+    def search(self, query: str, k: int, allowed: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """Return the `k` best scoring document ids, restricted to `allowed` if given."""
+        if not self._lengths:
+            return []
+        n = len(self._lengths)
+        average_length = self._total_length / n
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for _id, frequency in postings.items():
+                if allowed is not None and _id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[_id] / average_length)
+                scores[_id] = scores.get(_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,66 @@
+import time
+
+from collections import OrderedDict
+from typing import Generic, Optional, Hashable, Tuple, TypeVar
+from pydantic import BaseModel
+
+V = TypeVar('V')
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    """entries dropped to stay within the size bound"""
+    expirations: int = 0
+    """entries dropped because they outlived the ttl"""
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class LRUCache(Generic[V]):
+    """Size-bounded least recently used cache whose entries optionally expire after `ttl` seconds."""
+
+    max_size: int
+    ttl: Optional[float]
+    stats: CacheStats
+    # value and monotonic time it was put at, least recently used first
+    _entries: "OrderedDict[Hashable, Tuple[V, float]]"
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+            del self._entries[key]
+            self.stats.expirations += 1
+            entry = None
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: V):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def pop(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
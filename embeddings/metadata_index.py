@@ -0,0 +1,73 @@
+import json
+
+from typing import Any, Dict, Hashable, Iterable, Set
+
+
+def _freeze(value: Any) -> Hashable:
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        # lists and dicts in metadata are compared by their json form
+        return '__json__', json.dumps(value, sort_keys=True)
+
+
+class MetadataIndex:
+    """Inverted index from metadata key/value to document ids.
+
+    Matching follows the filter semantics of FaissSearcher: a document matches when for
+    every filter key, `metadata.get(key)` is the filter value or one of the filter values.
+    """
+
+    metadatas: Dict[str, Dict]
+    _postings: Dict[str, Dict[Hashable, Set[str]]]
+
+    def __init__(self):
+        self.metadatas = {}
+        self._postings = {}
+
+    def __len__(self) -> int:
+        return len(self.metadatas)
+
+    def add(self, metadatas: Dict[str, Dict]):
+        """Add documents, replacing the metadata of ids already indexed."""
+        self.remove(_id for _id in metadatas if _id in self.metadatas)
+        for _id, metadata in metadatas.items():
+            self.metadatas[_id] = metadata
+            for key, value in metadata.items():
+                self._postings.setdefault(key, {}).setdefault(_freeze(value), set()).add(_id)
+
+    def remove(self, ids: Iterable[str]):
+        for _id in list(ids):
+            metadata = self.metadatas.pop(_id, None)
+            if metadata is None:
+                continue
+            for key, value in metadata.items():
+                values = self._postings[key]
+                frozen = _freeze(value)
+                values[frozen].discard(_id)
+                if not values[frozen]:
+                    del values[frozen]
+                if not values:
+                    del self._postings[key]
+
+    def _match_key(self, key: str, values: list) -> Set[str]:
+        postings = self._postings.get(key, {})
+        matched: Set[str] = set()
+        for value in values:
+            matched.update(postings.get(_freeze(value), ()))
+        if None in values:
+            # metadata.get(key) is also None for documents without the key
+            with_key = set().union(*postings.values()) if postings else set()
+            matched.update(_id for _id in self.metadatas if _id not in with_key)
+        return matched
+
+    def match(self, filter: Dict[str, Any]) -> Set[str]:
+        """Return the ids of the documents matching `filter`."""
+        matched = None
+        for key, value in filter.items():
+            key_matched = self._match_key(key, value if isinstance(value, list) else [value])
+            matched = key_matched if matched is None else matched & key_matched
+            if not matched:
+                return set()
+        return matched if matched is not None else set(self.metadatas)
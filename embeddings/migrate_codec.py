@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import logging
+
+from embeddings.codec import VectorCodec
+from embeddings.docstore import RedisStore
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="migrate-codec", description="Re-encode the vectors of a docstore index with another codec."
+    )
+    parser.add_argument(
+        "--url", type=str, required=True, help="redis url"
+    )
+    parser.add_argument(
+        "--index-name", type=str, required=True, help="docstore index name"
+    )
+    parser.add_argument(
+        "--codec", type=VectorCodec, choices=list(VectorCodec), required=True, help="target vector codec"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="vectors re-encoded per pipeline"
+    )
+    parser.add_argument(
+        "--cluster", action="store_true", help="connect to a redis cluster"
+    )
+    parser.add_argument(
+        "--log-level", type=str, default="INFO", help="log level"
+    )
+
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    store = RedisStore(url=args.url, index_name=args.index_name, batch_size=args.batch_size, cluster=args.cluster)
+    previous = await store.vector_codec()
+    migrated = await store.migrate_vector_codec(args.codec)
+    logger.info('migrated %d vectors of index %s from %s to %s', migrated, args.index_name, previous.value, args.codec.value)
+    await store.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
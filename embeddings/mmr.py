@@ -0,0 +1,43 @@
+import numpy as np
+
+from typing import List
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    # zero vectors have a cosine similarity of 0 to everything
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(
+    query_embedding: np.ndarray,
+    embeddings: np.ndarray,
+    lambda_mult: float = 0.5,
+    k: int = 4,
+) -> List[int]:
+    """Select `k` of `embeddings` by maximal marginal relevance to `query_embedding`.
+
+    Same selection as `langchain.vectorstores.utils.maximal_marginal_relevance`, but the
+    cosine similarities are computed on normalized vectors with one matrix product per
+    selected document, and the redundancy of every candidate is kept up to date
+    incrementally instead of being recomputed against all selected documents.
+    """
+    n = len(embeddings)
+    if min(k, n) <= 0:
+        return []
+    candidates = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(n, -1))
+    query = _normalize(np.asarray(query_embedding, dtype=np.float32).reshape(-1))
+    similarity_to_query = candidates @ query
+
+    selected = [int(np.argmax(similarity_to_query))]
+    redundancy = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        np.maximum(redundancy, candidates @ candidates[selected[-1]], out=redundancy)
+        scores = lambda_mult * similarity_to_query - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+    return selected
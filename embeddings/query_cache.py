@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import logging
+import unicodedata
+import numpy as np
+
+from typing import Optional, Dict, List
+from redis.asyncio import Redis as RedisClient
+from redis.exceptions import RedisError
+from langchain.embeddings.base import Embeddings
+
+from embeddings.lru import CacheStats, LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    """Unicode-normalize and collapse whitespace, case is kept as embedding models are case-sensitive."""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Embeddings wrapper caching query embeddings in an in-process lru and a redis tier shared by replicas.
+
+    Entries are keyed by the model name and the normalized query, and stored as float32 bytes.
+    Document embeddings are passed through uncached.
+
+    `stats` counts queries answered without the model as hits and the embedded ones as
+    misses, `local_stats` and `redis_stats` count the lookups of each tier.
+    """
+
+    embeddings: Embeddings
+    model_name: str
+    max_size: int
+    client: Optional[RedisClient]
+    ttl: Optional[int]
+    stats: CacheStats
+    redis_stats: CacheStats
+    _lru: LRUCache[bytes]
+    # concurrent misses for the same query share a single embedding call
+    _inflight: Dict[str, asyncio.Future]
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        *,
+        max_size: int = 10_000,
+        client: Optional[RedisClient] = None,
+        ttl: Optional[int] = 7 * 24 * 3600,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_size = max_size
+        self.client = client
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self.redis_stats = CacheStats()
+        self._lru = LRUCache(max_size)
+        self._inflight = {}
+
+    @property
+    def local_stats(self) -> CacheStats:
+        return self._lru.stats
+
+    def _cache_key(self, text: str) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode()).hexdigest()
+        return f'qemb:{self.model_name}:{digest}'
+
+    async def _redis_get(self, key: str) -> Optional[bytes]:
+        if self.client is None:
+            return None
+        try:
+            value = await self.client.get(key)
+        except RedisError:
+            # the shared tier is an optimization, fall back to the model when it's unavailable
+            logger.warning('failed to read query embedding from redis', exc_info=True)
+            value = None
+        if value is not None:
+            self.redis_stats.hits += 1
+        else:
+            self.redis_stats.misses += 1
+        return value
+
+    async def _redis_put(self, key: str, value: bytes):
+        if self.client is None:
+            return
+        try:
+            await self.client.set(key, value, ex=self.ttl)
+        except RedisError:
+            logger.warning('failed to write query embedding to redis', exc_info=True)
+
+    async def _load(self, key: str, text: str) -> bytes:
+        value = await self._redis_get(key)
+        if value is not None:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+            vector = await self.embeddings.aembed_query(text)
+            value = np.array(vector, dtype=np.float32).tobytes()
+            await self._redis_put(key, value)
+        self._lru.put(key, value)
+        return value
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._cache_key(text)
+        value = self._lru.get(key)
+        if value is not None:
+            self.stats.hits += 1
+            return np.frombuffer(value, dtype=np.float32).tolist()
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, text))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            # joins the load of the same query in flight
+            self.stats.hits += 1
+        value = await asyncio.shield(future)
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        # sync callers only get the in-process tier, the redis client is async
+        key = self._cache_key(text)
+        value = self._lru.get(key)
+        if value is not None:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+            value = np.array(self.embeddings.embed_query(text), dtype=np.float32).tobytes()
+            self._lru.put(key, value)
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
@@ -0,0 +1,537 @@
+import logging
+import math
+import uuid
+import warnings
+import numpy as np
+
+from typing import Any, Optional, Dict, Set, Tuple, List, Iterable, Callable, Type
+from redis.exceptions import ResponseError
+from langchain.schema.document import Document
+from langchain.schema.vectorstore import VST, VectorStore
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.utils import DistanceStrategy
+
+from embeddings.codec import VectorCodec, decode_vector, encode_vector
+from embeddings.docstore import RedisStore, filter_tag
+from embeddings.index import IndexKind, IndexSpec
+from embeddings.mmr import maximal_marginal_relevance
+
+logger = logging.getLogger(__name__)
+
+_METRICS = {
+    DistanceStrategy.EUCLIDEAN_DISTANCE: 'L2',
+    DistanceStrategy.MAX_INNER_PRODUCT: 'IP',
+    DistanceStrategy.COSINE: 'COSINE',
+}
+
+# aliases of the indexed fields, the filterable metadata keys are filter0, filter1...
+_VECTOR_FIELD = 'vector'
+_SCORE_FIELD = 'knn_score'
+
+
+class RedisSearcher(VectorStore):
+    """RedisSearcher searches the documents of a RedisStore with a redis search vector index.
+
+    The index is created over the document hashes of the store, which redis keeps up to
+    date on every write, so nothing is loaded in process and replicas need no syncing.
+    KNN and range queries run on the server, pre-filtered on the `filterable_metadata` of
+    the store, and return the contents along with the hits in a single reply.
+
+    It needs a redis with the search module, e.g. Redis Stack, and vectors stored as
+    float32, or float16 for search 2.10 and later. Scores are the distances redis
+    reports, except for MAX_INNER_PRODUCT where they are inner products as with faiss.
+    """
+
+    embedding: Embeddings
+    docstore: RedisStore
+    embedding_dim: int
+    distance_strategy: DistanceStrategy
+    index_spec: IndexSpec
+    index_name: str
+
+    # range searches without k return at most this many documents
+    range_limit: int = 10_000
+
+    _relevance_score_fn: Callable[[float], float]
+    # codec of the stored vectors, known once init has run
+    _codec: Optional[VectorCodec]
+
+    def __init__(
+        self,
+        docstore: RedisStore,
+        embedding_dim: int,
+        embeddings: Embeddings,
+        distance_strategy: DistanceStrategy = DistanceStrategy.EUCLIDEAN_DISTANCE,
+        index_spec: Optional[IndexSpec] = None,
+        index_name: Optional[str] = None,
+    ):
+        """Initialize with necessary components.
+
+        The search index is described by `index_spec`, whose kind must be flat or hnsw,
+        and named `index_name`, `vectors:<docstore index name>` by default. An existing
+        index is reused as it is, drop it to change its spec or the filterable metadata.
+        """
+        if docstore.cluster:
+            raise ValueError('redis search indexes are not supported in cluster mode')
+        if distance_strategy not in _METRICS:
+            raise ValueError(
+                "Unknown distance strategy, must be cosine, max_inner_product,"
+                " or euclidean"
+            )
+        index_spec = index_spec or IndexSpec()
+        if index_spec.kind not in (IndexKind.FLAT, IndexKind.HNSW):
+            raise ValueError(f'redis search only supports flat and hnsw indexes, not {index_spec.kind.value}')
+        self.embedding = embeddings
+        self.docstore = docstore
+        self.embedding_dim = embedding_dim
+        self.distance_strategy = distance_strategy
+        self.index_spec = index_spec
+        self.index_name = index_name or f'vectors:{docstore.index_name}'
+        self._relevance_score_fn = self._select_relevance_score_fn()
+        self._codec = None
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            return self._max_inner_product_relevance_score_fn
+        elif self.distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
+            return self._euclidean_relevance_score_fn
+        else:
+            return self._cosine_relevance_score_fn
+
+    def _schema(self) -> List[Any]:
+        attributes = [
+            'TYPE', self._codec.value.upper(),
+            'DIM', self.embedding_dim,
+            'DISTANCE_METRIC', _METRICS[self.distance_strategy],
+        ]
+        if self.index_spec.kind == IndexKind.HNSW:
+            attributes += ['M', self.index_spec.hnsw_m, 'EF_CONSTRUCTION', self.index_spec.ef_construction]
+        schema = [
+            self.docstore.vector_key, 'AS', _VECTOR_FIELD, 'VECTOR',
+            self.index_spec.kind.value.upper(), len(attributes), *attributes,
+        ]
+        for i, key in enumerate(self.docstore.filterable_metadata):
+            schema += [self.docstore._filter_field(key), 'AS', f'filter{i}', 'TAG']
+        return schema
+
+    async def init(self):
+        """Create the search index over the documents of the docstore unless it exists.
+
+        Documents already stored are indexed by redis in the background, writes made
+        afterward are searchable as soon as they return.
+        """
+        codec = await self.docstore.vector_codec()
+        if codec not in (VectorCodec.FLOAT32, VectorCodec.FLOAT16):
+            raise ValueError(
+                f'redis search can not index {codec.value} vectors, '
+                f'migrate index {self.docstore.index_name} to float32 first'
+            )
+        self._codec = codec
+        try:
+            await self.docstore.client.execute_command('FT.INFO', self.index_name)
+            return
+        except ResponseError:
+            # unknown index, a redis without the search module fails to create it below
+            pass
+        try:
+            await self.docstore.client.execute_command(
+                'FT.CREATE', self.index_name,
+                'ON', 'HASH',
+                'PREFIX', 1, self.docstore._redis_prefix(),
+                'SCHEMA', *self._schema(),
+            )
+            logger.info('created redis search index %s', self.index_name)
+        except ResponseError as e:
+            # another replica created it first
+            if 'already exists' not in str(e).lower():
+                raise
+
+    async def adrop_index(self):
+        """Drop the search index, the documents are kept."""
+        await self.docstore.client.execute_command('FT.DROPINDEX', self.index_name)
+
+    def _filter_query(self, filter: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Query clause matching the documents of `filter`, None if no document can match.
+
+        Like FaissSearcher, a document matches when for every filter key, `metadata.get(key)`
+        is the filter value or one of the filter values.
+        """
+        if not filter:
+            return '*'
+        clauses = []
+        for key, value in filter.items():
+            if key not in self.docstore.filterable_metadata:
+                raise ValueError(f'metadata key {key} is not in the filterable metadata of the docstore')
+            values = value if isinstance(value, list) else [value]
+            if not values:
+                return None
+            tags = '|'.join(filter_tag(v) for v in values)
+            clauses.append(f'@filter{self.docstore.filterable_metadata.index(key)}:{{{tags}}}')
+        return '(' + ' '.join(clauses) + ')'
+
+    def _search_command(
+        self,
+        vector: List[float],
+        k: Optional[int],
+        filter: Optional[Dict[str, Any]],
+        radius: Optional[float],
+        with_vectors: bool,
+    ) -> Optional[List[Any]]:
+        """FT.SEARCH arguments of a KNN query, or a range query with a radius, sorted by
+        score. None if the filter can't match anything."""
+        clause = self._filter_query(filter)
+        if clause is None:
+            return None
+        params: Dict[str, Any] = {'vec': encode_vector(vector, self._codec)}
+        if radius is None:
+            params['k'] = k
+            ef_runtime = ''
+            if self.index_spec.kind == IndexKind.HNSW:
+                params['ef'] = max(self.index_spec.ef_search, k)
+                ef_runtime = ' EF_RUNTIME $ef'
+            query = f'{clause}=>[KNN $k @{_VECTOR_FIELD} $vec{ef_runtime} AS {_SCORE_FIELD}]'
+            limit = k
+        else:
+            if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+                # redis ranges on 1 - inner product
+                radius = 1.0 - radius
+            params['radius'] = radius
+            query = f'@{_VECTOR_FIELD}:[VECTOR_RANGE $radius $vec]=>{{$YIELD_DISTANCE_AS: {_SCORE_FIELD}}}'
+            if clause != '*':
+                query = f'{clause} {query}'
+            limit = k if k is not None else self.range_limit
+        fields = [_SCORE_FIELD, *self.docstore._document_fields()]
+        if with_vectors:
+            fields.append(self.docstore.vector_key)
+        return [
+            'FT.SEARCH', self.index_name, query,
+            'PARAMS', 2 * len(params), *[item for param in params.items() for item in param],
+            'SORTBY', _SCORE_FIELD,
+            'RETURN', len(fields), *fields,
+            'LIMIT', 0, limit,
+            'DIALECT', 2,
+        ]
+
+    def _parse_hits(self, reply: List[Any], with_vectors: bool) -> List[Tuple[Document, float, Optional[np.ndarray]]]:
+        """Documents, scores and, if asked, vectors of an FT.SEARCH reply."""
+        hits = []
+        # the total comes first, then every key followed by its fields and values
+        for values in reply[2::2]:
+            fields = dict(zip(values[::2], values[1::2]))
+            document = self.docstore._parse_document([fields.get(field) for field in self.docstore._document_fields()])
+            if document is None:
+                # deleted while being searched
+                continue
+            score = float(fields[_SCORE_FIELD.encode()])
+            if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+                score = 1.0 - score
+            vector = decode_vector(fields[self.docstore.vector_key], self._codec) if with_vectors else None
+            hits.append((document, score, vector))
+        return hits
+
+    async def _search(
+        self,
+        embeddings: List[List[float]],
+        k: Optional[int],
+        filter: Optional[Dict[str, Any]] = None,
+        radius: Optional[float] = None,
+        with_vectors: bool = False,
+    ) -> List[List[Tuple[Document, float, Optional[np.ndarray]]]]:
+        """Run the query of every embedding, all in one pipeline."""
+        if self._codec is None:
+            raise RuntimeError('RedisSearcher.init must be awaited before searching')
+        commands = [self._search_command(embedding, k, filter, radius, with_vectors) for embedding in embeddings]
+        pipeline = self.docstore.client.pipeline(transaction=False)
+        for command in commands:
+            if command is not None:
+                _ = pipeline.execute_command(*command)
+        replies = iter(await pipeline.execute() if any(command is not None for command in commands) else [])
+        return [self._parse_hits(next(replies), with_vectors) if command is not None else [] for command in commands]
+
+    async def _missing_ids(self, ids: Iterable[str]) -> Set[str]:
+        ids = list(ids)
+        stored = await self.docstore.find_ids(ids)
+        return {_id for _id in ids if _id not in stored}
+
+    async def _similarity_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Return docs most similar to query, with their score.
+
+        The filter is applied by redis before the KNN search, so fetch_k is not needed and
+        kept for compatibility. A score_threshold turns the query into a range search.
+        """
+        results = await self._batch_similarity_search_with_score_by_vector(
+            [embedding], k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+        return results[0]
+
+    async def _batch_similarity_search_with_score_by_vector(
+        self,
+        embeddings: List[List[float]],
+        k: Optional[int] = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Tuple[Document, float]]]:
+        if not embeddings:
+            return []
+        results = await self._search(embeddings, k, filter, radius=kwargs.get("score_threshold"))
+        return [[(document, score) for document, score, _ in hits] for hits in results]
+
+    async def _similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        embedding = await self.embeddings.aembed_query(query)
+        return await self._similarity_search_with_score_by_vector(
+            embedding,
+            k,
+            filter=filter,
+            fetch_k=fetch_k,
+            **kwargs,
+        )
+
+    async def _max_marginal_relevance_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        *,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """Return docs and their similarity scores selected using the maximal marginal
+        relevance among the `fetch_k` nearest ones, fetched along with their vectors."""
+        hits = (await self._search([embedding], fetch_k, filter, with_vectors=True))[0]
+        if not hits:
+            return []
+        mmr_selected = maximal_marginal_relevance(
+            np.array(embedding, dtype=np.float32),
+            np.array([vector for _, _, vector in hits]),
+            k=k,
+            lambda_mult=lambda_mult,
+        )
+        return [(hits[j][0], hits[j][1]) for j in mmr_selected]
+
+    async def aadd_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        if len(texts) != len(metadatas):
+            raise ValueError("texts and metadatas must be the same length")
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        if len(ids) != len(texts):
+            raise ValueError("texts and ids must be the same length")
+        embeddings = await self.embeddings.aembed_documents(texts)
+        await self.docstore.add({_i: (t, e, m) for _i, t, e, m in zip(ids, texts, embeddings, metadatas)})
+        return ids
+
+    async def adelete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if ids is None:
+            raise ValueError("ids must be provided")
+        missing_ids = await self._missing_ids(ids)
+        if missing_ids:
+            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+        await self.docstore.delete(ids)
+        return True
+
+    async def aupdate_metadatas(self, metadatas: Dict[str, Dict]):
+        """Update the metadata of documents in the docstore, redis reindexes their filter tags."""
+        missing_ids = await self._missing_ids(metadatas)
+        if missing_ids:
+            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+        await self.docstore.update_metadatas(metadatas)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        raise NotImplementedError('RedisSearcher does not support sync calls')
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        raise NotImplementedError('RedisSearcher does not support sync calls')
+
+    @classmethod
+    def from_texts(
+        cls: Type[VST],
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> VST:
+        raise NotImplementedError('RedisSearcher does not support sync calls')
+
+    def _score_threshold(self, relevance_threshold: float) -> Optional[float]:
+        """The raw score matching a relevance threshold, None if the relevance function
+        isn't monotonic, as the inner product one isn't."""
+        if self.distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
+            return (1.0 - relevance_threshold) * math.sqrt(2)
+        elif self.distance_strategy == DistanceStrategy.COSINE:
+            return 1.0 - relevance_threshold
+        return None
+
+    async def asimilarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        score_threshold = kwargs.pop("score_threshold", None)
+        if score_threshold is not None and self._score_threshold(score_threshold) is not None:
+            kwargs["score_threshold"] = self._score_threshold(score_threshold)
+        docs_and_scores = await self._similarity_search_with_score(query, k, **kwargs)
+        docs_and_similarities = [(doc, self._relevance_score_fn(score)) for doc, score in docs_and_scores]
+        if any(
+            similarity < 0.0 or similarity > 1.0
+            for _, similarity in docs_and_similarities
+        ):
+            warnings.warn(
+                "Relevance scores must be between"
+                f" 0 and 1, got {docs_and_similarities}"
+            )
+
+        if score_threshold is not None:
+            docs_and_similarities = [
+                (doc, similarity)
+                for doc, similarity in docs_and_similarities
+                if similarity >= score_threshold
+            ]
+        return docs_and_similarities
+
+    async def asimilarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Document]:
+        docs_and_scores = await self._similarity_search_with_score(
+            query, k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+        return [doc for doc, _ in docs_and_scores]
+
+    async def asimilarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Document]:
+        docs_and_scores = await self._similarity_search_with_score_by_vector(
+            embedding,
+            k,
+            filter=filter,
+            fetch_k=fetch_k,
+            **kwargs,
+        )
+        return [doc for doc, _ in docs_and_scores]
+
+    async def abatch_similarity_search(
+        self,
+        queries: List[str],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Document]]:
+        """Return the docs most similar to each query, embedding all queries in one call."""
+        embeddings = await self.embeddings.aembed_documents(queries)
+        return await self.abatch_similarity_search_by_vector(
+            embeddings, k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+
+    async def abatch_similarity_search_by_vector(
+        self,
+        embeddings: List[List[float]],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Document]]:
+        results = await self._batch_similarity_search_with_score_by_vector(
+            embeddings, k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+        return [[doc for doc, _ in docs_and_scores] for docs_and_scores in results]
+
+    async def arange_search_with_score(
+        self,
+        query: str,
+        radius: float,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """Return the documents within `radius` of the query, best first, at most `k` of them
+        or `range_limit` if `k` is None.
+
+        The radius is a raw score as returned by `_similarity_search_with_score`.
+        """
+        embedding = await self.embeddings.aembed_query(query)
+        results = await self._batch_similarity_search_with_score_by_vector(
+            [embedding], k, filter=filter, score_threshold=radius
+        )
+        return results[0]
+
+    async def arange_search(
+        self,
+        query: str,
+        radius: float,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        docs_and_scores = await self.arange_search_with_score(query, radius, k, filter)
+        return [doc for doc, _ in docs_and_scores]
+
+    async def amax_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        embedding = await self.embeddings.aembed_query(query)
+        return await self.amax_marginal_relevance_search_by_vector(
+            embedding,
+            k=k,
+            fetch_k=fetch_k,
+            lambda_mult=lambda_mult,
+            filter=filter,
+            **kwargs,
+        )
+
+    async def amax_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        docs_and_scores = await self._max_marginal_relevance_search_with_score_by_vector(
+            embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter
+        )
+        return [doc for doc, _ in docs_and_scores]
@@ -0,0 +1,92 @@
+import asyncio
+import numpy as np
+
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Set, Tuple
+
+# blocking search of a batch of query vectors for their top k
+SearchFn = Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]
+
+
+class SearchBatcher:
+    """Merges single-query searches into batched searches run on `executor`, and fans the
+    results back out to the callers.
+
+    A query is searched right away when fewer than `max_in_flight` batches are running, so
+    a lone query never waits. Otherwise it is gathered with the queries arriving after it,
+    until a running batch finishes, `max_batch_size` queries are pending or it has waited
+    `max_wait` seconds.
+
+    `prepare` is called on the event loop when a batch is flushed and returns the blocking
+    search function for it, so that the batch sees the index state at flush time.
+    """
+
+    executor: Executor
+    prepare: Callable[[], SearchFn]
+    max_batch_size: int
+    max_wait: float
+    max_in_flight: int
+    _pending: List[Tuple[np.ndarray, int, asyncio.Future]]
+    _flush_handle: Optional[asyncio.TimerHandle]
+    # running batches, referenced so they aren't garbage collected
+    _tasks: Set[asyncio.Task]
+
+    def __init__(
+        self,
+        executor: Executor,
+        prepare: Callable[[], SearchFn],
+        max_batch_size: int = 64,
+        max_wait: float = 0.002,
+        max_in_flight: int = 1,
+    ):
+        self.executor = executor
+        self.prepare = prepare
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def search(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search a single query vector of shape (1, d)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((vector, k, future))
+        if len(self._tasks) < self.max_in_flight or len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._on_done)
+
+    def _on_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        # the queries gathered while it ran go out as the next batch
+        if self._pending and len(self._tasks) < self.max_in_flight:
+            self._flush()
+
+    async def _run(self, batch: List[Tuple[np.ndarray, int, asyncio.Future]]):
+        # the largest k covers every query, each caller gets its own top k back
+        k = max(k for _, k, _ in batch)
+        try:
+            search = self.prepare()
+            vectors = np.concatenate([vector for vector, _, _ in batch])
+            scores, indices = await asyncio.get_running_loop().run_in_executor(self.executor, search, vectors, k)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for row, (_, query_k, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((scores[row:row + 1, :query_k], indices[row:row + 1, :query_k]))
@@ -1,16 +1,57 @@
+import asyncio
+import logging
+import math
 import operator
 import uuid
 import warnings
 import numpy as np
 
-from typing import Any, Optional, Dict, Tuple, List, Iterable, Callable, Type
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Dict, Set, Tuple, List, Iterable, Callable, Type, Union
+from pydantic import BaseModel
 from langchain.schema.document import Document
 from langchain.schema.vectorstore import VST, VectorStore
 from langchain.embeddings.base import Embeddings
-from langchain.vectorstores.utils import DistanceStrategy, maximal_marginal_relevance
-from langchain.vectorstores.faiss import dependable_faiss_import
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain_community.vectorstores.faiss import dependable_faiss_import
 
-from embeddings.docstore import RedisStore
+from embeddings.docstore_base import Change, ChangeOp, DocStore, content_hash
+from embeddings.index import (
+    IndexKind,
+    IndexSpec,
+    ShardedIndex,
+    IndexEvaluation,
+    create_flat_index,
+    evaluate_index,
+    export_vectors,
+    rank_range_results,
+    selector_search_params,
+    search_params,
+    set_search_params,
+    supports_removal,
+    train_index,
+)
+from embeddings.id_map import DocIdMap
+from embeddings.index_lock import IndexLock
+from embeddings.lexical_index import LexicalIndex
+from embeddings.metadata_index import MetadataIndex
+from embeddings.mmr import maximal_marginal_relevance
+from embeddings.search_batcher import SearchBatcher, SearchFn
+from embeddings.snapshot import SnapshotManifest, new_version, read_latest_snapshot, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class IngestReport(BaseModel):
+    ids: List[str]
+    """document id of every input text, in input order"""
+    inserted: int = 0
+    """texts stored as new documents"""
+    updated: int = 0
+    """texts replacing the content or metadata of a stored document"""
+    skipped: int = 0
+    """texts already stored unchanged, or repeated within the input"""
 
 
 class FaissSearcher(VectorStore):
@@ -18,41 +59,106 @@ class FaissSearcher(VectorStore):
 
     embedding: Embeddings
     index: Any
-    docstore: RedisStore
-    index_to_docstore_id: Dict[int, str]
+    docstore: DocStore
+    index_to_docstore_id: DocIdMap
+    metadata_index: MetadataIndex
+    # bm25 index over the contents, for hybrid search
+    lexical_index: Optional[LexicalIndex]
     normalize_l2: bool
     distance_strategy: DistanceStrategy
+    num_shards: int
+    index_spec: IndexSpec
+    snapshot_dir: Optional[Path]
+    snapshot_keep: int
+
+    # filters matching at most this many documents are scored exhaustively
+    exhaustive_filter_limit: int = 1024
+    # deleted vectors are compacted away once they make up this share of the index
+    compact_ratio: float = 0.05
 
     _relevance_score_fn: Callable[[float], float]
+    _trained: bool
+    # keys of deleted documents whose vectors are still in the index
+    _tombstones: Set[int]
+    # (IDSelectorBatch, IDSelectorNot) excluding the tombstones, built lazily
+    _tombstone_selector: Optional[Tuple[Any, Any]]
+    # bumped whenever the index is compacted, so a concurrent training knows its snapshot is stale
+    _generation: int
+    _train_task: Optional[asyncio.Task]
+    # id of the last docstore change applied to the index
+    _change_id: str
+    _sync_task: Optional[asyncio.Task]
+    # index searches run on this pool, single queries are merged into batches first
+    _search_executor: ThreadPoolExecutor
+    _search_batcher: SearchBatcher
+    # shared by searches on the pool, held exclusively by index mutations on the event loop
+    _index_lock: IndexLock
 
     def __init__(
         self,
-        docstore: RedisStore,
+        docstore: DocStore,
         embedding_dim: int,
         embeddings: Embeddings,
         normalize_l2: bool = False,
         distance_strategy: DistanceStrategy = DistanceStrategy.EUCLIDEAN_DISTANCE,
+        index_spec: Optional[IndexSpec] = None,
+        snapshot_dir: Optional[Union[str, Path]] = None,
+        snapshot_keep: int = 2,
+        num_shards: int = 1,
+        lexical_search: bool = False,
+        search_workers: int = 1,
+        search_batch_size: int = 64,
+        search_batch_wait: float = 0.002,
     ):
         if distance_strategy != DistanceStrategy.EUCLIDEAN_DISTANCE and normalize_l2:
             warnings.warn(
                 "Normalizing l2 is not applicable for metric type: {strategy}".format(strategy=distance_strategy)
             )
 
-        faiss = dependable_faiss_import()
-        if distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
-            index = faiss.IndexFlatIP(embedding_dim)
-        else:
-            # Default to L2, currently other metric types not initialized.
-            index = faiss.IndexFlatL2(embedding_dim)
+        """Initialize with necessary components.
+
+        With `num_shards` > 1 the flat index is split into that many shards searched in
+        parallel, which only applies to flat indexes. With `lexical_search` the contents
+        are also kept in a bm25 index for `ahybrid_search`.
 
-        """Initialize with necessary components."""
+        Index searches run on a pool of `search_workers` threads so they don't block the
+        event loop. Unfiltered single queries are searched right away while a worker is
+        free. Once all are busy, queries are merged into batches of at most `search_batch_size`,
+        each sent when a worker frees up or after `search_batch_wait` seconds.
+        """
+        if num_shards > 1 and index_spec is not None and index_spec.kind != IndexKind.FLAT:
+            raise ValueError(f'sharding only supports flat indexes, not {index_spec.kind.value}')
         self.embedding = embeddings
-        self.index = index
+        self.num_shards = num_shards
+        # always start flat, the index described by index_spec is trained in the background
+        self.index = self._new_flat_index(embedding_dim, distance_strategy)
         self.docstore = docstore
-        self.index_to_docstore_id = {}
+        self.index_to_docstore_id = DocIdMap()
+        self.metadata_index = MetadataIndex()
+        self.lexical_index = LexicalIndex() if lexical_search else None
         self.distance_strategy = distance_strategy
         self.normalize_l2 = normalize_l2
+        self.index_spec = index_spec or IndexSpec()
+        self.snapshot_dir = Path(snapshot_dir) if snapshot_dir is not None else None
+        self.snapshot_keep = snapshot_keep
         self._relevance_score_fn = self._select_relevance_score_fn()
+        self._trained = False
+        self._tombstones = set()
+        self._tombstone_selector = None
+        self._generation = 0
+        self._train_task = None
+        self._change_id = '0-0'
+        self._sync_task = None
+        self._search_executor = ThreadPoolExecutor(search_workers, thread_name_prefix='faiss-search')
+        self._search_batcher = SearchBatcher(
+            self._search_executor, self._unfiltered_search, search_batch_size, search_batch_wait, search_workers
+        )
+        self._index_lock = IndexLock()
+
+    def _new_flat_index(self, embedding_dim: int, distance_strategy: DistanceStrategy) -> Any:
+        if self.num_shards > 1:
+            return ShardedIndex(embedding_dim, distance_strategy, self.num_shards)
+        return dependable_faiss_import().IndexIDMap2(create_flat_index(embedding_dim, distance_strategy))
 
     def _select_relevance_score_fn(self) -> Callable[[float], float]:
         # Default strategy is to rely on distance strategy provided in
@@ -77,26 +183,263 @@ class FaissSearcher(VectorStore):
         metadatas: List[Dict],
         ids: Optional[List[str]] = None,
     ) -> List[str]:
+        metadatas = metadatas or [{} for _ in texts]
         if len(texts) != len(embeddings):
             raise ValueError("texts and embeddings must be the same length")
         if len(texts) != len(metadatas):
             raise ValueError("texts and metadatas must be the same length")
 
         # Add to the index.
-        vector = np.array(embeddings, dtype=np.float32)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        async with self._index_lock.write():
+            self._add_local(ids, np.array(embeddings, dtype=np.float32), dict(zip(ids, metadatas)), texts)
+
+        # Add information to docstore.
+        await self.docstore.add({_i: (t, e, m) for _i, t, e, m in zip(ids, texts, embeddings, metadatas)})
+        return ids
+
+    def _add_local(
+        self, ids: List[str], vector: np.ndarray, metadatas: Dict[str, Dict], texts: Optional[List[str]] = None
+    ):
+        """Add vectors, metadata and texts to the local indexes only, ids already present are replaced.
+
+        Must be called with the index write lock held. Keys are assigned without awaiting
+        so that concurrent adds can't interleave them.
+        """
         if self.normalize_l2:
             faiss = dependable_faiss_import()
+            if not vector.flags.writeable:
+                # pages of an on-disk docstore may be read only views of its vector file
+                vector = vector.copy()
             faiss.normalize_L2(vector)
-        self.index.add(vector)
+        self._remove_local([_id for _id in ids if self.index_to_docstore_id.has_id(_id)])
+        keys = self.index_to_docstore_id.add(ids)
+        self.index.add_with_ids(vector, keys)
+        self.metadata_index.add(metadatas)
+        if self.lexical_index is not None and texts is not None:
+            self.lexical_index.add(dict(zip(ids, texts)))
+        self._maybe_train()
 
-        # Add information to docstore and index.
-        ids = ids or [str(uuid.uuid4()) for _ in texts]
-        await self.docstore.add({_i: (t, e, m) for _i, t, e, m in zip(ids, texts, embeddings, metadatas)})
+    def _remove_local(self, ids: List[str]):
+        """Remove documents from the local indexes only, ids must be present in the index.
+        Must be called with the index write lock held.
 
-        starting_len = len(self.index_to_docstore_id)
-        index_to_id = {starting_len + j: id_ for j, id_ in enumerate(ids)}
-        self.index_to_docstore_id.update(index_to_id)
-        return ids
+        This costs O(len(ids)): the vectors stay in the index as tombstones excluded
+        from searches, and are compacted away in one go once there are enough of them.
+        """
+        if not ids:
+            return
+        self._tombstones.update(self.index_to_docstore_id.remove(ids).tolist())
+        self._tombstone_selector = None
+        self.metadata_index.remove(ids)
+        if self.lexical_index is not None:
+            self.lexical_index.remove(ids)
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if not self._tombstones or len(self._tombstones) < self.compact_ratio * self.index.ntotal:
+            return
+        if supports_removal(self.index):
+            self.index.remove_ids(np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones)))
+            self._tombstones.clear()
+            self._tombstone_selector = None
+            self._generation += 1
+        else:
+            # hnsw can't remove vectors, rebuild it without the tombstones instead
+            self._schedule_training()
+
+    async def _search(
+        self,
+        vector: np.ndarray,
+        k: Optional[int],
+        filter: Optional[Dict[str, Any]] = None,
+        radius: Optional[float] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the index on the search pool, restricted to the documents matching `filter`.
+
+        The filter is resolved by the metadata index. Few matches are scored exhaustively,
+        which is cheaper and, unlike an hnsw graph walk, never misses any of them.
+        Otherwise the matches are pushed into the index search as an id selector.
+
+        With a `radius`, the index range search only returns the hits within it, at most `k`
+        of them or all if `k` is None.
+        """
+        if filter is None:
+            if radius is None and len(vector) == 1:
+                return await self._search_batcher.search(vector, k)
+            return await self._run_search(self._unfiltered_search(radius), vector, k)
+
+        faiss = dependable_faiss_import()
+        # matched documents are all alive, tombstones are excluded as well
+        matched = self.metadata_index.match(filter)
+        keys = self.index_to_docstore_id.keys_of(matched)
+        if len(keys) <= self.exhaustive_filter_limit:
+            if len(keys) == 0:
+                width = 0 if k is None else k
+                return np.full((len(vector), width), np.nan, dtype=np.float32), np.full((len(vector), width), -1)
+            # the matched vectors are copied out here, the pool only scores the copy
+            candidates = self.index.reconstruct_batch(keys)
+            scores, positions = await self._run_search(self._exhaustive_search(candidates, radius), vector, k)
+            return scores, np.where(positions >= 0, keys[positions], -1)
+        else:
+            selector = faiss.IDSelectorBatch(keys)
+            return await self._run_search(self._index_search(selector, radius), vector, k)
+
+    def _unfiltered_search(self, radius: Optional[float] = None) -> SearchFn:
+        """Search function excluding the tombstones, built on the event loop as of now."""
+        if not self._tombstones:
+            return self._index_search(None, radius)
+        if self._tombstone_selector is None:
+            faiss = dependable_faiss_import()
+            tombstones = faiss.IDSelectorBatch(
+                np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+            )
+            self._tombstone_selector = (tombstones, faiss.IDSelectorNot(tombstones))
+        return self._index_search(self._tombstone_selector[1], radius, self._tombstone_selector)
+
+    def _index_search(self, selector: Any, radius: Optional[float], *keep_alive: Any) -> SearchFn:
+        index = self.index
+        params = selector_search_params(index, selector) if selector is not None else None
+
+        def search(vectors: np.ndarray, k: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+            # selectors are referenced here, so the loop dropping them can't free them mid search
+            _ = selector, keep_alive
+            with self._index_lock.read():
+                if radius is None:
+                    return index.search(vectors, k, params=params)
+                lims, scores, keys = index.range_search(vectors, radius, params=params)
+            return rank_range_results(lims, scores, keys, k, self.distance_strategy)
+        return search
+
+    def _exhaustive_search(self, candidates: np.ndarray, radius: Optional[float]) -> SearchFn:
+        """Search function scoring every candidate, returning positions into `candidates`."""
+        faiss = dependable_faiss_import()
+        inner_product = self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+        metric = faiss.METRIC_INNER_PRODUCT if inner_product else faiss.METRIC_L2
+
+        def search(vectors: np.ndarray, k: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+            if radius is None:
+                return faiss.knn(vectors, candidates, k, metric=metric)
+            scores, positions = faiss.knn(vectors, candidates, len(candidates), metric=metric)
+            # same bounds as the index range search
+            within = scores > radius if inner_product else scores < radius
+            lims = np.concatenate([[0], np.cumsum(within.sum(axis=1))])
+            return rank_range_results(lims, scores[within], positions[within], k, self.distance_strategy)
+        return search
+
+    async def _run_search(
+        self, search: SearchFn, vector: np.ndarray, k: Optional[int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return await asyncio.get_running_loop().run_in_executor(self._search_executor, search, vector, k)
+
+    def _maybe_train(self, force: bool = False):
+        if (
+            not self._trained
+            and self.index.ntotal > 0
+            and (force or self.index.ntotal >= self.index_spec.train_threshold)
+        ):
+            self._schedule_training()
+
+    def _schedule_training(self):
+        if self.index_spec.kind != IndexKind.FLAT and self._train_task is None:
+            self._train_task = asyncio.create_task(self._train_and_swap())
+
+    async def _train_and_swap(self):
+        """Train the index described by index_spec on the live vectors of the current index,
+        which is an IDMap2 over a flat (initial training) or hnsw (rebuild) index."""
+        swapped = False
+        try:
+            generation = self._generation
+            current = self.index
+            dropped = set(self._tombstones)
+
+            def export_and_train() -> Tuple[Any, int]:
+                # the corpus is copied out on this thread, alongside searches but not mutations
+                with self._index_lock.read():
+                    keys, vectors = export_vectors(current)
+                alive = ~np.isin(keys, np.fromiter(dropped, dtype=np.int64, count=len(dropped)))
+                trained = train_index(
+                    self.index_spec, current.d, self.distance_strategy, vectors[alive], keys[alive]
+                )
+                return trained, len(keys)
+
+            index, ntotal = await asyncio.to_thread(export_and_train)
+            # swapped under the write lock, so snapshots copying the index on a thread see it atomically
+            async with self._index_lock.write():
+                # a compaction moves vectors, so the exported positions no longer line up with the index
+                if generation != self._generation or current is not self.index:
+                    logger.info('index was compacted while training %s index, retrying', self.index_spec.kind)
+                    return
+                # catch up with the vectors added to the index while training
+                if current.ntotal > ntotal:
+                    tail_keys, tail_vectors = export_vectors(current, ntotal)
+                    index.add_with_ids(tail_vectors, tail_keys)
+                self.index = index
+                self._trained = True
+                # tombstones which were left out of the training are gone for good
+                self._tombstones -= dropped
+                self._tombstone_selector = None
+                swapped = True
+            logger.info('swapped in trained %s index with %d vectors', self.index_spec.kind, index.ntotal)
+        except Exception:
+            logger.exception('failed to train %s index', self.index_spec.kind)
+            # don't retry a failing training on every add
+            swapped = True
+        finally:
+            self._train_task = None
+            if not swapped:
+                self._schedule_training()
+
+    async def atrain_index(self):
+        """Train the index described by index_spec now, regardless of the corpus size."""
+        self._maybe_train(force=True)
+        if self._train_task is not None:
+            await self._train_task
+
+    async def aevaluate_index(
+        self,
+        queries: List[List[float]],
+        k: int = 4,
+        params_grid: Optional[List[Dict[str, int]]] = None,
+    ) -> List[IndexEvaluation]:
+        """Report recall and latency of the trained index against an exact flat index.
+
+        The exact index is rebuilt page by page from the vectors in the docstore. The search params of
+        the trained index are left as they are.
+        """
+        if not self._trained:
+            raise ValueError('no trained index to evaluate, the searcher still uses a flat index')
+        if params_grid is None:
+            if self.index_spec.kind in (IndexKind.IVF_FLAT, IndexKind.IVF_PQ):
+                params_grid = [{'nprobe': nprobe} for nprobe in (1, 4, 16, 64, 256)]
+            elif self.index_spec.kind == IndexKind.HNSW:
+                params_grid = [{'efSearch': ef} for ef in (16, 32, 64, 128, 256)]
+            else:
+                params_grid = [{}]
+
+        faiss = dependable_faiss_import()
+        exact_index = faiss.IndexIDMap2(create_flat_index(self.index.d, self.distance_strategy))
+        async for page in self.docstore.iter_vector_pages():
+            # documents the index doesn't know of yet have no key to compare with
+            mask = np.array([self.index_to_docstore_id.has_id(_id) for _id in page.ids], dtype=bool)
+            if not mask.any():
+                continue
+            alive = [_id for _id, known in zip(page.ids, mask) if known]
+            vector = np.ascontiguousarray(page.vectors[mask], dtype=np.float32)
+            if self.normalize_l2:
+                faiss.normalize_L2(vector)
+            exact_index.add_with_ids(vector, self.index_to_docstore_id.keys_of(alive))
+        query_vector = np.array(queries, dtype=np.float32)
+        if self.normalize_l2:
+            faiss.normalize_L2(query_vector)
+        index = self.index
+
+        def evaluate() -> List[IndexEvaluation]:
+            # the grid is passed to each search, so it runs alongside the other searches
+            with self._index_lock.read():
+                return evaluate_index(index, exact_index, query_vector, k, params_grid)
+
+        return await asyncio.to_thread(evaluate)
 
     async def _similarity_search_with_score_by_vector(
         self,
@@ -122,42 +465,42 @@ class FaissSearcher(VectorStore):
             List of documents most similar to the query text and L2 distance
             in float for each. Lower score represents more similarity.
         """
-        vector = np.array([embedding], dtype=np.float32)
+        results = await self._batch_similarity_search_with_score_by_vector(
+            [embedding], k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+        return results[0]
+
+    async def _batch_similarity_search_with_score_by_vector(
+        self,
+        embeddings: List[List[float]],
+        k: Optional[int] = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Return docs most similar to each query, searching all queries in one
+        index call and hydrating all hits in one docstore call.
+
+        Args and returns are the ones of `_similarity_search_with_score_by_vector`, per query.
+        The filter is resolved by the metadata index and pushed into the index search,
+        so fetch_k is not needed anymore and kept for compatibility. A score_threshold is
+        pushed down as the radius of a range search, only the hits within it are hydrated.
+        """
+        if not embeddings:
+            return []
+        vector = np.array(embeddings, dtype=np.float32)
         if self.normalize_l2:
             faiss = dependable_faiss_import()
             faiss.normalize_L2(vector)
-        scores, indices = self.index.search(vector, k if filter is None else fetch_k)
-        docs = []
-        for j, i in enumerate(indices[0]):
-            if i == -1:
-                # This happens when not enough docs are returned.
-                continue
-            _id = self.index_to_docstore_id[i]
-            doc = await self.docstore.search(_id)
-            if filter is not None:
-                filter = {
-                    key: [value] if not isinstance(value, list) else value
-                    for key, value in filter.items()
-                }
-                if all(doc.metadata.get(key) in value for key, value in filter.items()):
-                    docs.append((doc, scores[0][j]))
-            else:
-                docs.append((doc, scores[0][j]))
-
-        score_threshold = kwargs.get("score_threshold")
-        if score_threshold is not None:
-            cmp = (
-                operator.ge
-                if self.distance_strategy
-                in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD)
-                else operator.le
-            )
-            docs = [
-                (doc, similarity)
-                for doc, similarity in docs
-                if cmp(similarity, score_threshold)
-            ]
-        return docs[:k]
+        scores, indices = await self._search(vector, k, filter, radius=kwargs.get("score_threshold"))
+        # -1 happens when not enough docs are returned, unmapped keys are deleted
+        # vectors which the index could not remove.
+        candidates = [
+            [(self.index_to_docstore_id[i], row_scores[j]) for j, i in enumerate(row) if i in self.index_to_docstore_id]
+            for row, row_scores in zip(indices, scores)
+        ]
+        hydrated = await self.docstore.search_many({_id for row in candidates for _id, _ in row})
+        return [[(hydrated[_id], score) for _id, score in row if _id in hydrated] for row in candidates]
 
     async def _similarity_search_with_score(
         self,
@@ -204,56 +547,216 @@ class FaissSearcher(VectorStore):
             List of Documents and similarity scores selected by maximal marginal
                 relevance and score for each.
         """
-        scores, indices = self.index.search(
-            np.array([embedding], dtype=np.float32),
-            fetch_k if filter is None else fetch_k * 2,
-        )
-        if filter is not None:
-            filtered_indices = []
-            for i in indices[0]:
-                if i == -1:
-                    # This happens when not enough docs are returned.
-                    continue
-                _id = self.index_to_docstore_id[i]
-                doc = await self.docstore.search(_id)
-                if all(
-                    doc.metadata.get(key) in value
-                    if isinstance(value, list)
-                    else doc.metadata.get(key) == value
-                    for key, value in filter.items()
-                ):
-                    filtered_indices.append(i)
-            indices = np.array([filtered_indices])
-        # -1 happens when not enough docs are returned.
-        embeddings = [self.index.reconstruct(int(i)) for i in indices[0] if i != -1]
+        scores, indices = await self._search(np.array([embedding], dtype=np.float32), fetch_k, filter)
+        # -1 happens when not enough docs are returned, unmapped keys are deleted
+        # vectors which the index could not remove.
+        candidates = [(i, score) for i, score in zip(indices[0], scores[0]) if i in self.index_to_docstore_id]
+        if not candidates:
+            return []
+        embeddings = self.index.reconstruct_batch(np.array([i for i, _ in candidates], dtype=np.int64))
         mmr_selected = maximal_marginal_relevance(
-            np.array([embedding], dtype=np.float32),
+            np.array(embedding, dtype=np.float32),
             embeddings,
             k=k,
             lambda_mult=lambda_mult,
         )
-        selected_indices = [indices[0][i] for i in mmr_selected]
-        selected_scores = [scores[0][i] for i in mmr_selected]
-        docs_and_scores = []
-        for i, score in zip(selected_indices, selected_scores):
-            if i == -1:
-                # This happens when not enough docs are returned.
-                continue
-            _id = self.index_to_docstore_id[i]
-            doc = await self.docstore.search(_id)
-            docs_and_scores.append((doc, score))
-        return docs_and_scores
+        selected_ids = [
+            (self.index_to_docstore_id[candidates[j][0]], candidates[j][1]) for j in mmr_selected
+        ]
+        hydrated = await self.docstore.search_many(_id for _id, _ in selected_ids)
+        return [(hydrated[_id], score) for _id, score in selected_ids if _id in hydrated]
 
     async def init(self):
-        _, ids_vectors = await self.docstore.scan_vectors()
-        ids = ids_vectors.keys()
-        if len(ids) > 0:
-            vector = np.array(list(ids_vectors.values()), dtype=np.float32)
-            if self.normalize_l2:
-                faiss = dependable_faiss_import()
-                faiss.normalize_L2(vector)
-            self.index.add(vector)
-            self.index_to_docstore_id.update(dict(enumerate(ids)))
+        if self.snapshot_dir is not None and await self._load_snapshot():
+            await self._load_lexical_index()
+            return
+
+        # remember where the scan starts, changes racing with it are replayed idempotently later
+        self._change_id = await self.docstore.last_change_id()
+        # pages go into the index as they arrive, the corpus is never held outside of it
+        async for page in self.docstore.iter_vector_pages():
+            async with self._index_lock.write():
+                self._add_local(page.ids, page.vectors, dict(zip(page.ids, page.metadatas)))
+        await self._load_lexical_index()
+        self._maybe_train()
+
+    async def _load_lexical_index(self):
+        if self.lexical_index is None:
+            return
+        _, ids_contents = await self.docstore.scan_contents()
+        async with self._index_lock.write():
+            self.lexical_index.add({
+                _id: content for _id, content in ids_contents.items() if self.index_to_docstore_id.has_id(_id)
+            })
+
+    async def _load_snapshot(self) -> bool:
+        snapshot = await asyncio.to_thread(read_latest_snapshot, self.snapshot_dir)
+        if snapshot is None:
+            return False
+        index, keys, ids, metadatas, tombstones, manifest = snapshot
+        if (
+            manifest.embedding_dim != self.index.d
+            or manifest.distance_strategy != self.distance_strategy
+            or manifest.normalize_l2 != self.normalize_l2
+            or manifest.index_kind not in (IndexKind.FLAT, self.index_spec.kind)
+            # flat snapshots from before stable keys hold a bare index keyed by position
+            or (manifest.index_kind == IndexKind.FLAT and not isinstance(index, dependable_faiss_import().IndexIDMap))
+        ):
+            logger.warning('snapshot %d does not match the searcher settings, rebuilding', manifest.version)
+            return False
+        first_change_id = await self.docstore.first_change_id()
+        if (
+            manifest.change_id != '0-0'
+            and first_change_id is not None
+            and _change_id_key(first_change_id) > _change_id_key(manifest.change_id)
+        ):
+            logger.warning('changes since snapshot %d were trimmed, rebuilding', manifest.version)
+            return False
+
+        if manifest.index_kind != IndexKind.FLAT:
+            set_search_params(index, search_params(self.index_spec))
+        self.index = ShardedIndex.from_index(index, self.distance_strategy, self.num_shards) if self.num_shards > 1 else index
+        self.index_to_docstore_id = DocIdMap.from_items(keys.tolist(), ids, manifest.next_id)
+        self.metadata_index = MetadataIndex()
+        self.metadata_index.add(dict(zip(ids, metadatas)))
+        self._trained = manifest.index_kind != IndexKind.FLAT
+        self._tombstones = set(tombstones.tolist())
+        self._tombstone_selector = None
+        await self._apply_changes(await self.docstore.read_changes(manifest.change_id), skip_own=False)
+        logger.info(
+            'loaded snapshot %d with %d vectors, synced up to change %s',
+            manifest.version, self.index.ntotal, self._change_id,
+        )
+        self._maybe_train()
+        return True
+
+    async def _apply_changes(self, changes: List[Change], skip_own: bool = True):
+        """Apply the net effect of docstore changes to the index.
+
+        With `skip_own`, changes made through this searcher's docstore are considered
+        to be in the index already and skipped.
+        """
+        if not changes:
+            return
+        # documents cached by the docstore may predate the changes
+        self.docstore.invalidate(_id for change in changes for _id in change.ids)
+        # the last add or delete of every id, None when it's an own change already applied,
+        # which overrides earlier changes of other replicas just like a later foreign one
+        last_ops: Dict[str, Optional[ChangeOp]] = {}
+        updated = set()
+        for change in changes:
+            if change.op == ChangeOp.UPDATE:
+                # metadata updates are cheap to refetch, so own ones are applied too in case
+                # they were made on the docstore directly
+                updated.update(change.ids)
+            else:
+                op = None if skip_own and change.origin == self.docstore.replica_id else change.op
+                for _id in change.ids:
+                    last_ops[_id] = op
+
+        added = [_id for _id, op in last_ops.items() if op == ChangeOp.ADD]
+        ids_vectors = await self.docstore.get_many_vectors(added) if added else {}
+        ids_contents = await self.docstore.get_many_contents(added) if added and self.lexical_index else {}
+        refetched = list(updated.union(added))
+        ids_metadatas = await self.docstore.get_many_metadatas(refetched) if refetched else {}
+        # nothing is awaited under the lock, re-added ids are removed as well so that their vectors are replaced
+        async with self._index_lock.write():
+            self._remove_local([
+                _id for _id, op in last_ops.items() if op is not None and self.index_to_docstore_id.has_id(_id)
+            ])
+            if ids_vectors:
+                self._add_local(
+                    list(ids_vectors.keys()),
+                    np.array(list(ids_vectors.values()), dtype=np.float32),
+                    {_id: ids_metadatas.get(_id, {}) for _id in ids_vectors},
+                    [ids_contents.get(_id, '') for _id in ids_vectors],
+                )
+            self.metadata_index.add({
+                _id: metadata for _id, metadata in ids_metadatas.items()
+                if _id in updated and self.index_to_docstore_id.has_id(_id)
+            })
+            self._change_id = changes[-1].change_id
+
+    def start_sync(self, block: int = 1000):
+        """Tail the docstore change stream in the background and apply the changes of other
+        replicas to the index as soon as they are logged.
+
+        Args:
+            block: milliseconds a single stream read waits for new changes.
+        """
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_loop(block))
+
+    async def astop_sync(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    async def _sync_loop(self, block: int):
+        while True:
+            try:
+                changes = await self.docstore.wait_changes(self._change_id, block, self.docstore.batch_size)
+                await self._apply_changes(changes)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('failed to apply changes after %s, retrying', self._change_id)
+                await asyncio.sleep(1)
+
+    async def asave_snapshot(self) -> Path:
+        """Write the index and its id mapping as a new snapshot version under snapshot_dir."""
+        if self.snapshot_dir is None:
+            raise ValueError('snapshot_dir must be provided to save snapshots')
+        faiss = dependable_faiss_import()
+        # changes logged after this id are replayed on load, so read it before the index
+        change_id = await self.docstore.last_change_id()
+
+        def serialize_and_write() -> Path:
+            # copied on this thread, the read lock keeps the index and its mappings consistent
+            with self._index_lock.read():
+                # shards are merged into one flat index, which is re-sharded on load
+                index = self.index.merged() if isinstance(self.index, ShardedIndex) else self.index
+                serialized_index = faiss.serialize_index(index)
+                keys = np.fromiter(
+                    self.index_to_docstore_id.keys(), dtype=np.int64, count=len(self.index_to_docstore_id)
+                )
+                ids = list(self.index_to_docstore_id.values())
+                metadatas = [self.metadata_index.metadatas.get(_id, {}) for _id in ids]
+                tombstones = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+                manifest = SnapshotManifest(
+                    version=new_version(),
+                    change_id=change_id,
+                    index_kind=self.index_spec.kind if self._trained else IndexKind.FLAT,
+                    embedding_dim=index.d,
+                    distance_strategy=self.distance_strategy,
+                    normalize_l2=self.normalize_l2,
+                    next_id=self.index_to_docstore_id.next_key,
+                )
+            return write_snapshot(
+                self.snapshot_dir,
+                serialized_index,
+                keys,
+                ids,
+                metadatas,
+                tombstones,
+                manifest,
+                self.snapshot_keep,
+            )
+
+        return await asyncio.to_thread(serialize_and_write)
+
+    async def aupdate_metadatas(self, metadatas: Dict[str, Dict]):
+        """Update the metadata of documents in the docstore and the metadata index."""
+        async with self._index_lock.write():
+            missing_ids = {_id for _id in metadatas if not self.index_to_docstore_id.has_id(_id)}
+            if missing_ids:
+                raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+            self.metadata_index.add(metadatas)
+        await self.docstore.update_metadatas(metadatas)
 
     def add_texts(
         self,
@@ -289,36 +792,127 @@ class FaissSearcher(VectorStore):
         ids: Optional[List[str]] = None,
         **kwargs: Any,
     ) -> List[str]:
-        # add vectors to docstore
+        report = await self.aupsert_texts(texts, metadatas, ids)
+        return report.ids
+
+    async def aupsert_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        vectors: Optional[Dict[str, List[float]]] = None,
+    ) -> IngestReport:
+        """Add texts, embedding only new or changed content.
+
+        Texts are matched to stored documents by id when ids are given, else by content hash,
+        so that identical texts map onto a single document. Unchanged documents are skipped,
+        or only get their metadata updated, and content already stored under another id
+        reuses its embedding. `vectors` are embeddings computed beforehand, by content hash.
+        """
         texts = list(texts)
-        embeddings = await self.embeddings.aembed_documents(texts)
-        return await self._add(texts, embeddings, metadatas, ids)
+        metadatas = metadatas or [{} for _ in texts]
+        if len(texts) != len(metadatas):
+            raise ValueError("texts and metadatas must be the same length")
+        if ids is not None and len(ids) != len(texts):
+            raise ValueError("texts and ids must be the same length")
 
-    async def adelete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        hashes = [content_hash(text) for text in texts]
+        owners = await self.docstore.find_content_hashes(hashes)
         if ids is None:
-            raise ValueError("ids must be provided")
-        missing_ids = set(ids).difference(self.index_to_docstore_id.values())
-        if missing_ids:
-            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+            new_ids: Dict[str, str] = {}
+            ids = [owners.get(digest) or new_ids.setdefault(digest, str(uuid.uuid4())) for digest in hashes]
+        report = IngestReport(ids=ids)
 
-        reversed_index = {id_: idx for idx, id_ in self.index_to_docstore_id.items()}
-        index_to_delete = [reversed_index[id_] for id_ in ids]
+        # the last occurrence of an id wins, earlier ones are skipped
+        positions = {_id: i for i, _id in enumerate(ids)}
+        report.skipped += len(ids) - len(positions)
+        stored_hashes = await self.docstore.get_many_content_hashes(positions)
+        unchanged = [_id for _id, i in positions.items() if stored_hashes.get(_id) == hashes[i]]
+        stored_metadatas = await self.docstore.get_many_metadatas(unchanged)
 
-        self.index.remove_ids(np.array(index_to_delete, dtype=np.int64))
-        await self.docstore.delete(ids)
+        metadata_updates: Dict[str, Dict] = {}
+        for _id in unchanged:
+            if stored_metadatas.get(_id) == metadatas[positions[_id]]:
+                report.skipped += 1
+            else:
+                metadata_updates[_id] = metadatas[positions[_id]]
+                report.updated += 1
+        unchanged_ids = set(unchanged)
+        changed = [_id for _id in positions if _id not in unchanged_ids]
+        for _id in changed:
+            if _id in stored_hashes:
+                report.updated += 1
+            else:
+                report.inserted += 1
 
-        remaining_ids = [
-            id_
-            for i, id_ in sorted(self.index_to_docstore_id.items())
-            if i not in index_to_delete
-        ]
-        self.index_to_docstore_id = {i: id_ for i, id_ in enumerate(remaining_ids)}
+        if metadata_updates:
+            self.metadata_index.add(
+                {_id: metadata for _id, metadata in metadata_updates.items() if self.index_to_docstore_id.has_id(_id)}
+            )
+            await self.docstore.update_metadatas(metadata_updates)
+        if changed:
+            vectors = await self._content_vectors(
+                [hashes[positions[_id]] for _id in changed], texts, hashes, owners, vectors or {}
+            )
+            await self._add(
+                [texts[positions[_id]] for _id in changed],
+                [vectors[hashes[positions[_id]]] for _id in changed],
+                [metadatas[positions[_id]] for _id in changed],
+                changed,
+            )
+        logger.debug(
+            'ingested %d texts: %d inserted, %d updated, %d skipped',
+            len(texts), report.inserted, report.updated, report.skipped,
+        )
+        return report
+
+    async def _content_vectors(
+        self,
+        needed: List[str],
+        texts: List[str],
+        hashes: List[str],
+        owners: Dict[str, str],
+        known: Dict[str, List[float]],
+    ) -> Dict[str, List[float]]:
+        """Embeddings by content hash, reused from `known` or stored documents where possible."""
+        by_hash = {digest: known[digest] for digest in needed if digest in known}
+        needed = set(needed).difference(by_hash)
+        vectors = await self.docstore.get_many_vectors([owners[digest] for digest in needed if digest in owners])
+        by_hash.update((digest, vectors[owners[digest]]) for digest in needed if owners.get(digest) in vectors)
+        to_embed = {digest: text for text, digest in zip(texts, hashes) if digest in needed and digest not in by_hash}
+        if to_embed:
+            embeddings = await self.embeddings.aembed_documents(list(to_embed.values()))
+            by_hash.update(zip(to_embed.keys(), embeddings))
+        return by_hash
+
+    async def adelete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if ids is None:
+            raise ValueError("ids must be provided")
+        async with self._index_lock.write():
+            # checked under the lock, a concurrent delete may be waiting on it too
+            missing_ids = {_id for _id in ids if not self.index_to_docstore_id.has_id(_id)}
+            if missing_ids:
+                raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+            self._remove_local(ids)
+        await self.docstore.delete(ids)
 
         return True
 
+    def _score_threshold(self, relevance_threshold: float) -> Optional[float]:
+        """The raw score matching a relevance threshold, None if the relevance function
+        isn't monotonic, as the inner product one isn't."""
+        if self.distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
+            return (1.0 - relevance_threshold) * math.sqrt(2)
+        elif self.distance_strategy == DistanceStrategy.COSINE:
+            return 1.0 - relevance_threshold
+        return None
+
     async def asimilarity_search_with_relevance_scores(
         self, query: str, k: int = 4, **kwargs: Any
     ) -> List[Tuple[Document, float]]:
+        score_threshold = kwargs.pop("score_threshold", None)
+        if score_threshold is not None and self._score_threshold(score_threshold) is not None:
+            kwargs["score_threshold"] = self._score_threshold(score_threshold)
         docs_and_scores = await self._similarity_search_with_score(query, k, **kwargs)
         docs_and_similarities = [(doc, self._relevance_score_fn(score)) for doc, score in docs_and_scores]
         if any(
@@ -330,7 +924,6 @@ class FaissSearcher(VectorStore):
                 f" 0 and 1, got {docs_and_similarities}"
             )
 
-        score_threshold = kwargs.pop("score_threshold", None)
         if score_threshold is not None:
             docs_and_similarities = [
                 (doc, similarity)
@@ -369,6 +962,111 @@ class FaissSearcher(VectorStore):
         )
         return [doc for doc, _ in docs_and_scores]
 
+    async def abatch_similarity_search(
+        self,
+        queries: List[str],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Document]]:
+        """Return the docs most similar to each query, embedding all queries in one call."""
+        embeddings = await self.embeddings.aembed_documents(queries)
+        return await self.abatch_similarity_search_by_vector(
+            embeddings, k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+
+    async def abatch_similarity_search_by_vector(
+        self,
+        embeddings: List[List[float]],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Document]]:
+        results = await self._batch_similarity_search_with_score_by_vector(
+            embeddings, k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+        return [[doc for doc, _ in docs_and_scores] for docs_and_scores in results]
+
+    async def arange_search_with_score(
+        self,
+        query: str,
+        radius: float,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """Return the documents within `radius` of the query, best first, at most `k` of them
+        or all if `k` is None.
+
+        The radius is a raw score as returned by `_similarity_search_with_score`: a squared
+        l2 distance, or an inner product for MAX_INNER_PRODUCT.
+        """
+        embedding = await self.embeddings.aembed_query(query)
+        results = await self._batch_similarity_search_with_score_by_vector(
+            [embedding], k, filter=filter, score_threshold=radius
+        )
+        return results[0]
+
+    async def arange_search(
+        self,
+        query: str,
+        radius: float,
+        k: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        docs_and_scores = await self.arange_search_with_score(query, radius, k, filter)
+        return [doc for doc, _ in docs_and_scores]
+
+    async def ahybrid_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        rrf_k: int = 60,
+    ) -> List[Tuple[Document, float]]:
+        """Return the docs best ranked by bm25 and vector similarity combined with reciprocal
+        rank fusion, along with their fused score.
+
+        The bm25 ranking is computed on a worker thread while the query is being embedded. Each ranking
+        contributes its top `fetch_k` docs, a doc at rank r scoring 1 / (rrf_k + r).
+        """
+        if self.lexical_index is None:
+            raise ValueError('hybrid search needs a searcher created with lexical_search=True')
+        allowed = self.metadata_index.match(filter) if filter is not None else None
+        lexical_index = self.lexical_index
+
+        def lexical_search() -> List[Tuple[str, float]]:
+            # the lexical index is only mutated along with the vector index
+            with self._index_lock.read():
+                return lexical_index.search(query, fetch_k, allowed)
+
+        lexical, embedding = await asyncio.gather(
+            asyncio.to_thread(lexical_search), self.embeddings.aembed_query(query)
+        )
+
+        _, indices = await self._search(np.array([embedding], dtype=np.float32), fetch_k, filter)
+        vector = [self.index_to_docstore_id[i] for i in indices[0] if i in self.index_to_docstore_id]
+        fused: Dict[str, float] = {}
+        for ranking in ([_id for _id, _ in lexical], vector):
+            for rank, _id in enumerate(ranking, start=1):
+                fused[_id] = fused.get(_id, 0.0) + 1 / (rrf_k + rank)
+        selected = sorted(fused.items(), key=operator.itemgetter(1), reverse=True)[:k]
+        hydrated = await self.docstore.search_many([_id for _id, _ in selected])
+        return [(hydrated[_id], score) for _id, score in selected if _id in hydrated]
+
+    async def ahybrid_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Document]:
+        docs_and_scores = await self.ahybrid_search_with_score(query, k, filter=filter, fetch_k=fetch_k, **kwargs)
+        return [doc for doc, _ in docs_and_scores]
+
     async def amax_marginal_relevance_search(
         self,
         query: str,
@@ -400,4 +1098,9 @@ class FaissSearcher(VectorStore):
         docs_and_scores = await self._max_marginal_relevance_search_with_score_by_vector(
             embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter
         )
-        return [doc for doc, _ in docs_and_scores]
\ No newline at end of file
+        return [doc for doc, _ in docs_and_scores]
+
+
+def _change_id_key(change_id: str) -> Tuple[int, int]:
+    ms, seq = change_id.split('-')
+    return int(ms), int(seq)
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+from pathlib import Path
+from typing import Any, Dict, Optional, List, Tuple
+from pydantic import BaseModel
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from embeddings.index import IndexKind
+
+
+class SnapshotManifest(BaseModel):
+    version: int
+    """milliseconds since epoch when the snapshot was taken"""
+    change_id: str
+    """id of the last docstore change reflected in the snapshot"""
+    index_kind: IndexKind
+    """kind of the snapshot index, flat until a trained index was swapped in"""
+    embedding_dim: int
+    distance_strategy: DistanceStrategy
+    normalize_l2: bool
+    next_id: int
+    """next key to hand out, keys are never reused"""
+
+
+_INDEX_FILE = 'index.faiss'
+_KEYS_FILE = 'keys.npy'
+_IDS_FILE = 'ids.json'
+_METADATAS_FILE = 'metadatas.json'
+_TOMBSTONES_FILE = 'tombstones.npy'
+_MANIFEST_FILE = 'manifest.json'
+
+
+def write_snapshot(
+    directory: Path,
+    serialized_index: np.ndarray,
+    keys: np.ndarray,
+    ids: List[str],
+    metadatas: List[Dict],
+    tombstones: np.ndarray,
+    manifest: SnapshotManifest,
+    keep: int = 2,
+) -> Path:
+    """Write a versioned snapshot under `directory` and prune all but the `keep` latest ones.
+
+    The snapshot is written to a temporary directory first and renamed into place,
+    so readers never see a partially written snapshot.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / f'{manifest.version:016d}'
+    tmp = directory / f'.tmp-{manifest.version:016d}'
+    tmp.mkdir()
+    serialized_index.tofile(tmp / _INDEX_FILE)
+    np.save(tmp / _KEYS_FILE, keys.astype(np.int64))
+    (tmp / _IDS_FILE).write_text(json.dumps(ids))
+    (tmp / _METADATAS_FILE).write_text(json.dumps(metadatas))
+    np.save(tmp / _TOMBSTONES_FILE, tombstones.astype(np.int64))
+    # manifest goes last, a snapshot without one is incomplete
+    (tmp / _MANIFEST_FILE).write_text(manifest.model_dump_json())
+    os.rename(tmp, target)
+
+    for stale in _snapshot_dirs(directory)[:-keep]:
+        shutil.rmtree(stale, ignore_errors=True)
+    return target
+
+
+def read_latest_snapshot(
+    directory: Path,
+) -> Optional[Tuple[Any, np.ndarray, List[str], List[Dict], np.ndarray, SnapshotManifest]]:
+    """Load the latest complete snapshot under `directory`.
+
+    The index is read into memory as it is: this saves scanning the docstore and
+    rebuilding the index, training and hnsw graph included, not the memory it takes.
+    """
+    snapshots = _snapshot_dirs(directory)
+    if not snapshots:
+        return None
+
+    faiss = dependable_faiss_import()
+    latest = snapshots[-1]
+    manifest = SnapshotManifest.model_validate_json((latest / _MANIFEST_FILE).read_bytes())
+    # IO_FLAG_MMAP only maps ivf inverted lists, and the index of IO_FLAG_MMAP_IFC rejects
+    # adds, the searcher keeps adding to the loaded index
+    index = faiss.read_index(str(latest / _INDEX_FILE))
+    keys = np.load(latest / _KEYS_FILE)
+    ids = json.loads((latest / _IDS_FILE).read_text())
+    metadatas = json.loads((latest / _METADATAS_FILE).read_text())
+    # snapshots taken before deletes were tombstoned don't have any
+    tombstones_path = latest / _TOMBSTONES_FILE
+    tombstones = np.load(tombstones_path) if tombstones_path.exists() else np.empty(0, dtype=np.int64)
+    return index, keys, ids, metadatas, tombstones, manifest
+
+
+def new_version() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def _snapshot_dirs(directory: Path) -> List[Path]:
+    if not directory.exists():
+        return []
+    return sorted(
+        path for path in directory.iterdir()
+        if path.is_dir() and not path.name.startswith('.') and (path / _MANIFEST_FILE).exists()
+    )
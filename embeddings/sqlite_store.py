@@ -0,0 +1,474 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import numpy as np
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from langchain.schema.document import Document
+
+from embeddings.codec import (
+    ContentCodec,
+    MetadataCodec,
+    check_codec_dependencies,
+    decode_content,
+    decode_metadata,
+    encode_content,
+    encode_metadata,
+)
+from embeddings.docstore_base import Change, ChangeOp, VectorPage, chunks, content_hash
+
+_DATABASE_FILE = 'docstore.sqlite3'
+_VECTORS_FILE = 'vectors.f32'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    slot INTEGER NOT NULL UNIQUE,
+    content BLOB NOT NULL,
+    content_codec TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    metadata BLOB NOT NULL,
+    metadata_codec TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_content_hash ON documents (content_hash);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    ids TEXT NOT NULL,
+    origin TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+# stays below the bound parameters limit of older sqlite builds
+_MAX_PARAMS = 900
+
+
+class SqliteStore:
+    """Embedded store for documents, a drop in for RedisStore on a single node.
+
+    Contents and metadata live in a SQLite database in WAL mode. Vectors are float32
+    rows of a contiguous file next to it, every document owning a row, which is memory
+    mapped for reads so that `iter_vector_pages` hands faiss views of the mapping rather
+    than decoded copies. Rows of deleted documents are left unused.
+
+    Several processes may share the directory: WAL lets readers run alongside the one
+    writer, and searchers catch up with each other's writes through the changes table,
+    whose change ids are `<seq>-0`.
+    """
+
+    path: Path
+    batch_size: int
+    changelog_maxlen: int
+    replica_id: str
+    metadata_codec: MetadataCodec
+    content_compression_threshold: Optional[int]
+    change_poll_interval: float
+    _connection: sqlite3.Connection
+    # the connection is shared by the threads blocking calls run on
+    _lock: threading.Lock
+    _dim: Optional[int]
+    _mapped: Optional[np.ndarray]
+
+    def __init__(
+        self,
+        *,
+        path: str,
+        batch_size: int,
+        changelog_maxlen: int = 100_000,
+        replica_id: Optional[str] = None,
+        metadata_codec: MetadataCodec = MetadataCodec.JSON,
+        content_compression_threshold: Optional[int] = None,
+        busy_timeout: float = 5.0,
+        change_poll_interval: float = 0.05,
+    ):
+        """`path` is the directory holding the database and the vector file. Writers wait
+        up to `busy_timeout` seconds for the write lock of other processes, and
+        `wait_changes` polls for new changes every `change_poll_interval` seconds."""
+        check_codec_dependencies(
+            metadata_codec, ContentCodec.ZSTD if content_compression_threshold is not None else ContentCodec.PLAIN
+        )
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.changelog_maxlen = changelog_maxlen
+        self.replica_id = replica_id or uuid.uuid4().hex
+        self.metadata_codec = metadata_codec
+        self.content_compression_threshold = content_compression_threshold
+        self.change_poll_interval = change_poll_interval
+        # transactions are begun explicitly, see _transaction
+        self._connection = sqlite3.connect(
+            self.path / _DATABASE_FILE, timeout=busy_timeout, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._dim = None
+        self._mapped = None
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        def locked():
+            with self._lock:
+                return fn(*args)
+        return await asyncio.to_thread(locked)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+
+    def _select_in(self, query: str, values: List[Any]) -> List[Tuple]:
+        """Run `query`, whose `{}` is replaced by a list of placeholders, over `values` in chunks."""
+        rows = []
+        for chunk in chunks(values, _MAX_PARAMS):
+            rows.extend(self._connection.execute(query.format(','.join('?' * len(chunk))), chunk).fetchall())
+        return rows
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: Any):
+        self._connection.execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+            (key, str(value)),
+        )
+
+    def _load_dim(self) -> Optional[int]:
+        if self._dim is None:
+            dim = self._meta('dim')
+            self._dim = int(dim) if dim is not None else None
+        return self._dim
+
+    def _vectors(self, rows: int) -> np.ndarray:
+        """Read only mapping of the vector file holding at least `rows` rows. It's mapped
+        again when it has grown, views of a previous mapping stay valid."""
+        dim = self._load_dim()
+        if self._mapped is None or len(self._mapped) < rows:
+            size = os.path.getsize(self.path / _VECTORS_FILE) // (4 * dim)
+            self._mapped = np.memmap(self.path / _VECTORS_FILE, dtype=np.float32, mode='r', shape=(size, dim))
+        return self._mapped
+
+    def _write_vectors(self, slots: np.ndarray, vectors: np.ndarray):
+        fd = os.open(self.path / _VECTORS_FILE, os.O_RDWR | os.O_CREAT)
+        try:
+            row_bytes = vectors.shape[1] * 4
+            order = np.argsort(slots)
+            slots, vectors = slots[order], vectors[order]
+            # consecutive slots are written in one go, new documents get consecutive slots
+            breaks = np.flatnonzero(np.diff(slots) != 1) + 1
+            for run_slots, run_vectors in zip(np.split(slots, breaks), np.split(vectors, breaks)):
+                os.pwrite(fd, np.ascontiguousarray(run_vectors).tobytes(), int(run_slots[0]) * row_bytes)
+        finally:
+            os.close(fd)
+
+    def _log_change(self, connection: sqlite3.Connection, op: ChangeOp, ids: List[str]):
+        cursor = connection.execute(
+            'INSERT INTO changes (op, ids, origin) VALUES (?, ?, ?)', (op.value, json.dumps(ids), self.replica_id)
+        )
+        connection.execute('DELETE FROM changes WHERE seq <= ?', (cursor.lastrowid - self.changelog_maxlen,))
+
+    def _encode_content(self, content: str) -> Tuple[bytes, str]:
+        codec = ContentCodec.PLAIN
+        if (
+            self.content_compression_threshold is not None
+            and len(content.encode()) >= self.content_compression_threshold
+        ):
+            codec = ContentCodec.ZSTD
+        return encode_content(content, codec), codec.value
+
+    @staticmethod
+    def _document(content: bytes, content_codec: str, metadata: bytes, metadata_codec: str) -> Document:
+        return Document(
+            page_content=decode_content(content, ContentCodec(content_codec)),
+            metadata=decode_metadata(metadata, MetadataCodec(metadata_codec)),
+        )
+
+    def invalidate(self, ids: Iterable[str]):
+        """Documents are read from the local database, nothing is cached."""
+
+    def _search_many(self, ids: List[str]) -> Dict[str, Document]:
+        rows = self._select_in(
+            'SELECT id, content, content_codec, metadata, metadata_codec FROM documents WHERE id IN ({})', ids
+        )
+        return {row[0]: self._document(*row[1:]) for row in rows}
+
+    async def search(self, _id: str) -> Document:
+        documents = await self._run(self._search_many, [_id])
+        if _id not in documents:
+            raise ValueError(f'no content for id: {_id}')
+        return documents[_id]
+
+    async def search_many(self, ids: Iterable[str]) -> Dict[str, Document]:
+        return await self._run(self._search_many, list(ids))
+
+    def _add(self, datas: List[Tuple[str, Tuple[str, List[float], Dict]]]):
+        vectors = np.asarray([vector for _, (_, vector, _) in datas], dtype=np.float32)
+        with self._transaction() as connection:
+            dim = self._load_dim()
+            if dim is None:
+                self._set_meta('dim', vectors.shape[1])
+                self._dim = dim = vectors.shape[1]
+            if vectors.shape[1] != dim:
+                raise ValueError(f'vectors of dim {vectors.shape[1]} added to a store of dim {dim}')
+            ids = [_id for _id, _ in datas]
+            slots = dict(self._select_in('SELECT id, slot FROM documents WHERE id IN ({})', ids))
+            next_slot = int(self._meta('next_slot') or 0)
+            for _id in ids:
+                if _id not in slots:
+                    slots[_id] = next_slot
+                    next_slot += 1
+            self._write_vectors(np.array([slots[_id] for _id in ids], dtype=np.int64), vectors)
+            rows = []
+            for _id, (content, _, metadata) in datas:
+                rows.append((
+                    _id,
+                    slots[_id],
+                    *self._encode_content(content),
+                    content_hash(content),
+                    encode_metadata(metadata, self.metadata_codec),
+                    self.metadata_codec.value,
+                ))
+            connection.executemany(
+                'INSERT INTO documents (id, slot, content, content_codec, content_hash, metadata, metadata_codec) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                'content = excluded.content, content_codec = excluded.content_codec, '
+                'content_hash = excluded.content_hash, metadata = excluded.metadata, '
+                'metadata_codec = excluded.metadata_codec',
+                rows,
+            )
+            self._set_meta('next_slot', next_slot)
+            self._log_change(connection, ChangeOp.ADD, ids)
+
+    async def add(self, datas: Dict[str, Tuple[str, List[float], Dict]]):
+        for batch in chunks(list(datas.items()), self.batch_size):
+            await self._run(self._add, batch)
+
+    def _delete(self, ids: List[str]):
+        with self._transaction() as connection:
+            for chunk in chunks(ids, _MAX_PARAMS):
+                connection.execute(f'DELETE FROM documents WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+            self._log_change(connection, ChangeOp.DELETE, ids)
+
+    async def delete(self, ids: List[str]):
+        await self._run(self._delete, list(ids))
+
+    def _update_metadatas(self, batch: List[Tuple[str, Dict]]):
+        with self._transaction() as connection:
+            connection.executemany(
+                'UPDATE documents SET metadata = ?, metadata_codec = ? WHERE id = ?',
+                [
+                    (encode_metadata(metadata, self.metadata_codec), self.metadata_codec.value, _id)
+                    for _id, metadata in batch
+                ],
+            )
+            self._log_change(connection, ChangeOp.UPDATE, [_id for _id, _ in batch])
+
+    # only metadata can be updated
+    async def update_metadatas(self, metadatas: Dict[str, Dict]):
+        for batch in chunks(list(metadatas.items()), self.batch_size):
+            await self._run(self._update_metadatas, batch)
+
+    def _get_many_contents(self, ids: List[str]) -> Dict[str, str]:
+        rows = self._select_in('SELECT id, content, content_codec FROM documents WHERE id IN ({})', ids)
+        return {_id: decode_content(content, ContentCodec(codec)) for _id, content, codec in rows}
+
+    async def get_content(self, _id: str) -> str:
+        contents = await self._run(self._get_many_contents, [_id])
+        if _id not in contents:
+            raise ValueError(f'no content for id: {_id}')
+        return contents[_id]
+
+    async def get_many_contents(self, ids: Iterable[str]) -> Dict[str, str]:
+        return await self._run(self._get_many_contents, list(ids))
+
+    def _get_many_metadatas(self, ids: List[str]) -> Dict[str, Dict]:
+        rows = self._select_in('SELECT id, metadata, metadata_codec FROM documents WHERE id IN ({})', ids)
+        return {_id: decode_metadata(metadata, MetadataCodec(codec)) for _id, metadata, codec in rows}
+
+    async def get_metadata(self, _id: str) -> Dict:
+        metadatas = await self._run(self._get_many_metadatas, [_id])
+        if _id not in metadatas:
+            raise ValueError(f'no metadata for id: {_id}')
+        return metadatas[_id]
+
+    async def get_many_metadatas(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        return await self._run(self._get_many_metadatas, list(ids))
+
+    def _get_many_vectors(self, ids: List[str]) -> Dict[str, List[float]]:
+        rows = self._select_in('SELECT id, slot FROM documents WHERE id IN ({})', ids)
+        if not rows:
+            return {}
+        vectors = self._vectors(max(slot for _, slot in rows) + 1)
+        return {_id: vectors[slot].tolist() for _id, slot in rows}
+
+    async def get_vector(self, _id: str) -> List[float]:
+        vectors = await self._run(self._get_many_vectors, [_id])
+        if _id not in vectors:
+            raise ValueError(f'no vector for id: {_id}')
+        return vectors[_id]
+
+    async def get_many_vectors(self, ids: Iterable[str]) -> Dict[str, List[float]]:
+        return await self._run(self._get_many_vectors, list(ids))
+
+    def _get_many_content_hashes(self, ids: List[str]) -> Dict[str, str]:
+        return dict(self._select_in('SELECT id, content_hash FROM documents WHERE id IN ({})', ids))
+
+    async def get_many_content_hashes(self, ids: Iterable[str]) -> Dict[str, str]:
+        """Content hash of each document."""
+        return await self._run(self._get_many_content_hashes, list(ids))
+
+    def _find_content_hashes(self, hashes: List[str]) -> Dict[str, str]:
+        return dict(self._select_in('SELECT content_hash, id FROM documents WHERE content_hash IN ({})', hashes))
+
+    async def find_content_hashes(self, hashes: Iterable[str]) -> Dict[str, str]:
+        """Id of a document currently holding each content hash, unknown hashes are left out."""
+        return await self._run(self._find_content_hashes, list(hashes))
+
+    def _scan(self, columns: str, cursor: Optional[int], count: Optional[int]) -> Tuple[int, List[Tuple]]:
+        """Rows in rowid order from after `cursor`, every row if it's None. Returns the
+        last rowid as the next cursor, 0 once done."""
+        if cursor is None:
+            return 0, self._connection.execute(f'SELECT {columns} FROM documents ORDER BY rowid').fetchall()
+        limit = count or self.batch_size
+        rows = self._connection.execute(
+            f'SELECT rowid, {columns} FROM documents WHERE rowid > ? ORDER BY rowid LIMIT ?', (cursor, limit)
+        ).fetchall()
+        return (rows[-1][0] if len(rows) == limit else 0), [row[1:] for row in rows]
+
+    async def scan_ids(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, List[str]]:
+        cursor, rows = await self._run(self._scan, 'id', cursor, count)
+        return cursor, [_id for _id, in rows]
+
+    async def scan_contents(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, str]]:
+        cursor, rows = await self._run(self._scan, 'id, content, content_codec', cursor, count)
+        return cursor, {_id: decode_content(content, ContentCodec(codec)) for _id, content, codec in rows}
+
+    def _scan_vectors(self, cursor: Optional[int], count: Optional[int]) -> Tuple[int, Dict[str, List[float]]]:
+        cursor, rows = self._scan('id, slot', cursor, count)
+        if not rows:
+            return cursor, {}
+        vectors = self._vectors(max(slot for _, slot in rows) + 1)
+        return cursor, {_id: vectors[slot].tolist() for _id, slot in rows}
+
+    async def scan_vectors(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, List[float]]]:
+        return await self._run(self._scan_vectors, cursor, count)
+
+    async def scan_metadatas(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, Dict]]:
+        cursor, rows = await self._run(self._scan, 'id, metadata, metadata_codec', cursor, count)
+        return cursor, {_id: decode_metadata(metadata, MetadataCodec(codec)) for _id, metadata, codec in rows}
+
+    def _scan_all(
+        self, cursor: Optional[int], count: Optional[int]
+    ) -> Tuple[int, Dict[str, Tuple[str, List[float], Dict]]]:
+        cursor, rows = self._scan('id, slot, content, content_codec, metadata, metadata_codec', cursor, count)
+        if not rows:
+            return cursor, {}
+        vectors = self._vectors(max(row[1] for row in rows) + 1)
+        return cursor, {
+            _id: (
+                decode_content(content, ContentCodec(content_codec)),
+                vectors[slot].tolist(),
+                decode_metadata(metadata, MetadataCodec(metadata_codec)),
+            )
+            for _id, slot, content, content_codec, metadata, metadata_codec in rows
+        }
+
+    async def scan_all(
+        self, cursor: Optional[int] = None, count: Optional[int] = None
+    ) -> Tuple[int, Dict[str, Tuple[str, List[float], Dict]]]:
+        return await self._run(self._scan_all, cursor, count)
+
+    def _vector_page(self, after_slot: int, page_size: int) -> Optional[Tuple[int, VectorPage]]:
+        rows = self._connection.execute(
+            'SELECT id, slot, metadata, metadata_codec FROM documents WHERE slot > ? ORDER BY slot LIMIT ?',
+            (after_slot, page_size),
+        ).fetchall()
+        if not rows:
+            return None
+        slots = np.array([slot for _, slot, _, _ in rows], dtype=np.int64)
+        mapped = self._vectors(int(slots[-1]) + 1)
+        if slots[-1] - slots[0] + 1 == len(slots):
+            # no deleted rows in between, the page is a view of the mapping
+            vectors = mapped[slots[0]:slots[-1] + 1]
+        else:
+            vectors = mapped[slots]
+        metadatas = [decode_metadata(metadata, MetadataCodec(codec)) for _, _, metadata, codec in rows]
+        return int(slots[-1]), VectorPage([_id for _id, _, _, _ in rows], vectors, metadatas)
+
+    async def iter_vector_pages(self, page_size: Optional[int] = None) -> AsyncIterator[VectorPage]:
+        """Scan the vectors and metadata of the store page by page, in slot order.
+
+        Vectors are views of the read only vector file mapping where a page's rows are
+        consecutive, copy them before writing to them.
+        """
+        after_slot = -1
+        while True:
+            page = await self._run(self._vector_page, after_slot, page_size or self.batch_size)
+            if page is None:
+                break
+            after_slot, vector_page = page
+            yield vector_page
+
+    def _changes(self, query: str, args: Tuple) -> List[Change]:
+        rows = self._connection.execute(query, args).fetchall()
+        return [
+            Change(change_id=f'{seq}-0', op=ChangeOp(op), ids=json.loads(ids), origin=origin)
+            for seq, op, ids, origin in rows
+        ]
+
+    async def last_change_id(self) -> str:
+        """Id of the latest change, `0-0` if nothing was logged yet."""
+        changes = await self._run(
+            self._changes, 'SELECT seq, op, ids, origin FROM changes ORDER BY seq DESC LIMIT 1', ()
+        )
+        return changes[0].change_id if changes else '0-0'
+
+    async def first_change_id(self) -> Optional[str]:
+        """Id of the oldest change still kept in the trimmed changes table."""
+        changes = await self._run(self._changes, 'SELECT seq, op, ids, origin FROM changes ORDER BY seq LIMIT 1', ())
+        return changes[0].change_id if changes else None
+
+    async def read_changes(self, after: str, count: Optional[int] = None) -> List[Change]:
+        """Read the changes logged after the change id `after`, oldest first."""
+        return await self._run(
+            self._changes,
+            'SELECT seq, op, ids, origin FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+            (int(after.split('-')[0]), count or -1),
+        )
+
+    async def wait_changes(self, after: str, block: int, count: Optional[int] = None) -> List[Change]:
+        """Like `read_changes`, but polls up to `block` milliseconds, 0 for ever, until a
+        change is logged."""
+        deadline = time.monotonic() + block / 1000 if block > 0 else None
+        while True:
+            changes = await self.read_changes(after, count)
+            if changes or (deadline is not None and time.monotonic() >= deadline):
+                return changes
+            await asyncio.sleep(self.change_poll_interval)
+
+    async def aclose(self):
+        await self._run(self._connection.close)
@@ -0,0 +1,215 @@
+import asyncio
+import hashlib
+import fakeredis
+import numpy as np
+import pytest
+
+from typing import Callable, List
+from langchain.embeddings.base import Embeddings
+
+from embeddings.docstore import RedisStore
+from embeddings.docstore_base import ChangeOp, DocStore, content_hash
+from embeddings.searcher import FaissSearcher
+from embeddings.sqlite_store import SqliteStore
+
+DIM = 8
+
+pytestmark = pytest.mark.anyio
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic embeddings seeded by the text."""
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], 'little')
+        return np.random.default_rng(seed).standard_normal(DIM).astype(np.float32).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+@pytest.fixture(params=['redis', 'sqlite'])
+def make_store(request, tmp_path) -> Callable[[], DocStore]:
+    """Factory of stores sharing one backend, as replicas would."""
+    server = fakeredis.FakeServer()
+
+    def make() -> DocStore:
+        if request.param == 'redis':
+            store = RedisStore(url='redis://localhost', index_name='test', batch_size=4)
+            store.client = fakeredis.FakeAsyncRedis(server=server)
+            return store
+        return SqliteStore(path=str(tmp_path), batch_size=4, change_poll_interval=0.01)
+
+    return make
+
+
+@pytest.fixture
+async def store(make_store):
+    store = make_store()
+    yield store
+    await store.aclose()
+
+
+def documents(n: int):
+    rng = np.random.default_rng(0)
+    return {
+        f'doc{i}': (f'content {i}', rng.standard_normal(DIM).astype(np.float32).tolist(), {'group': i % 3})
+        for i in range(n)
+    }
+
+
+async def scan_pages(scan, count: int) -> dict:
+    """Everything a cursor scan returns, page by page."""
+    merged = {}
+    cursor = 0
+    while True:
+        cursor, page = await scan(cursor, count)
+        # scan_ids pages are lists of ids
+        merged.update(page if isinstance(page, dict) else dict.fromkeys(page))
+        if not cursor:
+            return merged
+
+
+async def test_add_and_read(store):
+    datas = documents(10)
+    await store.add(datas)
+
+    document = await store.search('doc3')
+    assert document.page_content == 'content 3'
+    assert document.metadata == {'group': 0}
+    found = await store.search_many(['doc1', 'doc2', 'missing'])
+    assert {_id: doc.page_content for _id, doc in found.items()} == {'doc1': 'content 1', 'doc2': 'content 2'}
+    assert await store.get_content('doc4') == 'content 4'
+    assert await store.get_metadata('doc4') == {'group': 1}
+    np.testing.assert_allclose(await store.get_vector('doc4'), datas['doc4'][1], rtol=1e-6)
+    assert set(await store.get_many_vectors(['doc1', 'missing'])) == {'doc1'}
+    assert await store.get_many_content_hashes(['doc5']) == {'doc5': content_hash('content 5')}
+    assert await store.find_content_hashes([content_hash('content 6'), 'unknown']) == {
+        content_hash('content 6'): 'doc6'
+    }
+    with pytest.raises(ValueError):
+        await store.search('missing')
+
+
+async def test_overwrite_delete_and_update(store):
+    await store.add(documents(6))
+    await store.add({'doc1': ('replaced', [1.0] * DIM, {'group': 9})})
+    assert await store.get_content('doc1') == 'replaced'
+    assert await store.get_vector('doc1') == [1.0] * DIM
+
+    await store.delete(['doc2', 'doc3'])
+    assert set(await store.search_many(['doc2', 'doc3', 'doc4'])) == {'doc4'}
+    with pytest.raises(ValueError):
+        await store.get_content('doc2')
+
+    await store.update_metadatas({'doc4': {'group': 7}, 'doc5': {}})
+    assert await store.get_many_metadatas(['doc4', 'doc5']) == {'doc4': {'group': 7}, 'doc5': {}}
+    assert await store.get_content('doc4') == 'content 4'
+
+
+async def test_scans(store):
+    datas = documents(11)
+    await store.add(datas)
+    await store.delete(['doc0'])
+    expected = {_id: data for _id, data in datas.items() if _id != 'doc0'}
+
+    cursor, ids = await store.scan_ids()
+    assert cursor == 0 and sorted(ids) == sorted(expected)
+    assert set(await scan_pages(store.scan_ids, 3)) == set(expected)
+
+    _, contents = await store.scan_contents()
+    assert contents == {_id: content for _id, (content, _, _) in expected.items()}
+    assert await scan_pages(store.scan_contents, 3) == contents
+
+    _, metadatas = await store.scan_metadatas()
+    assert metadatas == {_id: metadata for _id, (_, _, metadata) in expected.items()}
+    assert await scan_pages(store.scan_metadatas, 3) == metadatas
+
+    _, vectors = await store.scan_vectors()
+    assert set(vectors) == set(expected)
+    assert set(await scan_pages(store.scan_vectors, 3)) == set(expected)
+
+    _, everything = await store.scan_all()
+    assert {_id: (content, metadata) for _id, (content, _, metadata) in everything.items()} == {
+        _id: (content, metadata) for _id, (content, _, metadata) in expected.items()
+    }
+    assert set(await scan_pages(store.scan_all, 3)) == set(expected)
+
+
+async def test_iter_vector_pages(store):
+    datas = documents(10)
+    await store.add(datas)
+    await store.delete(['doc4'])
+
+    pages = [page async for page in store.iter_vector_pages(3)]
+    ids = [_id for page in pages for _id in page.ids]
+    assert sorted(ids) == sorted(_id for _id in datas if _id != 'doc4')
+    for page in pages:
+        assert page.vectors.dtype == np.float32
+        assert page.vectors.shape == (len(page.ids), DIM)
+        for _id, vector, metadata in zip(page.ids, page.vectors, page.metadatas):
+            np.testing.assert_allclose(vector, datas[_id][1], rtol=1e-6)
+            assert metadata == datas[_id][2]
+
+
+async def test_change_log(store):
+    assert await store.last_change_id() == '0-0'
+    assert await store.first_change_id() is None
+    await store.add(documents(2))
+    await store.delete(['doc0'])
+    await store.update_metadatas({'doc1': {'group': 5}})
+
+    changes = await store.read_changes('0-0')
+    assert [(change.op, change.ids) for change in changes] == [
+        (ChangeOp.ADD, ['doc0', 'doc1']),
+        (ChangeOp.DELETE, ['doc0']),
+        (ChangeOp.UPDATE, ['doc1']),
+    ]
+    assert all(change.origin == store.replica_id for change in changes)
+    assert await store.first_change_id() == changes[0].change_id
+    assert await store.last_change_id() == changes[-1].change_id
+    assert await store.read_changes(changes[0].change_id, count=1) == changes[1:2]
+
+    last = changes[-1].change_id
+    assert await store.wait_changes(last, 50) == []
+    waiting = asyncio.create_task(store.wait_changes(last, 5000))
+    await asyncio.sleep(0.05)
+    await store.delete(['doc1'])
+    woken = await asyncio.wait_for(waiting, 5)
+    assert [(change.op, change.ids) for change in woken] == [(ChangeOp.DELETE, ['doc1'])]
+
+
+async def test_searcher_round_trip(make_store):
+    writer = FaissSearcher(make_store(), DIM, HashEmbeddings())
+    await writer.init()
+    ids = await writer.aadd_texts([f'text {i}' for i in range(12)], [{'group': i % 2} for i in range(12)])
+
+    reader = FaissSearcher(make_store(), DIM, HashEmbeddings())
+    await reader.init()
+    assert sorted(reader.index_to_docstore_id.values()) == sorted(ids)
+    found = await reader.asimilarity_search('text 5', k=1)
+    assert found[0].page_content == 'text 5'
+    filtered = await reader.asimilarity_search('text 5', k=3, filter={'group': 0})
+    assert len(filtered) == 3 and all(doc.metadata['group'] == 0 for doc in filtered)
+
+    reader.start_sync(block=20)
+    try:
+        await writer.adelete(ids[:2])
+        await writer.aadd_texts(['late text'], [{'group': 1}], ids=['late'])
+        await writer.aupdate_metadatas({ids[2]: {'group': 9}})
+        for _ in range(200):
+            if reader.metadata_index.metadatas.get(ids[2]) == {'group': 9}:
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(reader.index_to_docstore_id.values()) == sorted(ids[2:] + ['late'])
+        assert (await reader.asimilarity_search('late text', k=1))[0].page_content == 'late text'
+        assert [doc.page_content for doc in await reader.asimilarity_search('x', k=1, filter={'group': 9})] == [
+            'text 2'
+        ]
+    finally:
+        await reader.astop_sync()
+        await writer.docstore.aclose()
+        await reader.docstore.aclose()
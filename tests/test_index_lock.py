@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import pytest
+
+from embeddings.index_lock import IndexLock
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_readers_share_and_writer_waits_off_the_loop():
+    lock = IndexLock()
+    both_reading = threading.Barrier(2, timeout=5)
+    release = threading.Event()
+
+    def read():
+        with lock.read():
+            # only passes once both readers are inside together
+            both_reading.wait()
+            release.wait(5)
+
+    readers = [asyncio.create_task(asyncio.to_thread(read)) for _ in range(2)]
+    await asyncio.sleep(0.05)
+
+    written = asyncio.Event()
+
+    async def write():
+        async with lock.write():
+            written.set()
+
+    writer = asyncio.create_task(write())
+    # the loop keeps running while the writer waits for the readers
+    await asyncio.sleep(0.05)
+    assert not written.is_set()
+
+    # readers arriving while the writer waits are held back until it's done
+    def late_read() -> bool:
+        with lock.read():
+            return written.is_set()
+
+    late = asyncio.create_task(asyncio.to_thread(late_read))
+    await asyncio.sleep(0.05)
+    assert not late.done()
+
+    release.set()
+    await asyncio.wait_for(asyncio.gather(*readers, writer), 5)
+    assert written.is_set()
+    assert await asyncio.wait_for(late, 5)
@@ -0,0 +1,83 @@
+import os
+import uuid
+import pytest
+
+from langchain.vectorstores.utils import DistanceStrategy
+
+from embeddings.docstore import RedisStore, filter_tag
+from embeddings.index import IndexKind, IndexSpec
+from embeddings.redis_searcher import RedisSearcher
+from tests.test_docstore import DIM, HashEmbeddings
+
+# e.g. redis://localhost:6380 for `docker run -p 6380:6379 redis/redis-stack-server`
+REDIS_STACK_URL = os.environ.get('REDIS_STACK_URL')
+
+pytestmark = pytest.mark.anyio
+
+
+def test_filter_tag_matches_like_the_metadata_index():
+    assert filter_tag(True) == filter_tag(1) == filter_tag(1.0)
+    assert filter_tag(False) == filter_tag(0)
+    assert filter_tag(1) != filter_tag('1')
+    assert filter_tag(None) != filter_tag(0)
+    assert filter_tag({'a': 1, 'b': [2]}) == filter_tag({'b': [2], 'a': 1})
+
+
+def test_filter_query():
+    store = RedisStore(url='redis://localhost', index_name='test', batch_size=4, filterable_metadata=['group', 'tag'])
+    searcher = RedisSearcher(store, DIM, HashEmbeddings())
+    assert searcher._filter_query(None) == '*'
+    assert searcher._filter_query({'tag': [1, 'a'], 'group': 2}) == (
+        f'(@filter1:{{{filter_tag(1)}|{filter_tag("a")}}} @filter0:{{{filter_tag(2)}}})'
+    )
+    assert searcher._filter_query({'group': []}) is None
+    with pytest.raises(ValueError):
+        searcher._filter_query({'other': 1})
+
+
+@pytest.fixture(params=[IndexKind.FLAT, IndexKind.HNSW])
+async def searcher(request):
+    if REDIS_STACK_URL is None:
+        pytest.skip('set REDIS_STACK_URL to a redis with the search module')
+    store = RedisStore(
+        url=REDIS_STACK_URL, index_name=f'test-{uuid.uuid4().hex}', batch_size=4, filterable_metadata=['group']
+    )
+    searcher = RedisSearcher(
+        store, DIM, HashEmbeddings(), distance_strategy=DistanceStrategy.COSINE,
+        index_spec=IndexSpec(kind=request.param),
+    )
+    await searcher.init()
+    yield searcher
+    await searcher.adrop_index()
+    await store.drop()
+    await store.aclose()
+
+
+async def test_search(searcher):
+    texts = [f'text {i}' for i in range(20)]
+    ids = await searcher.aadd_texts(texts, [{'group': i % 3 == 0} for i in range(20)])
+
+    docs_and_scores = await searcher._similarity_search_with_score('text 7', k=3)
+    assert docs_and_scores[0][0].page_content == 'text 7'
+    assert docs_and_scores[0][1] == pytest.approx(0.0, abs=1e-5)
+    assert [score for _, score in docs_and_scores] == sorted(score for _, score in docs_and_scores)
+
+    # booleans are stored, and matched by ints, like with FaissSearcher
+    filtered = await searcher.asimilarity_search('text 7', k=20, filter={'group': 1})
+    assert sorted(doc.page_content for doc in filtered) == sorted(texts[i] for i in range(0, 20, 3))
+
+    radius = docs_and_scores[2][1]
+    in_range = await searcher.arange_search_with_score('text 7', radius + 1e-5)
+    assert len(in_range) >= 3 and all(score <= radius + 1e-5 for _, score in in_range)
+
+    batches = await searcher.abatch_similarity_search(['text 1', 'text 2'], k=1)
+    assert [docs[0].page_content for docs in batches] == ['text 1', 'text 2']
+    assert len(await searcher.amax_marginal_relevance_search('text 7', k=3, fetch_k=10)) == 3
+
+    await searcher.aupdate_metadatas({ids[7]: {'group': 'moved'}})
+    moved = await searcher.asimilarity_search('text 0', k=5, filter={'group': 'moved'})
+    assert [doc.page_content for doc in moved] == ['text 7']
+    await searcher.adelete([ids[7]])
+    assert await searcher.asimilarity_search('text 0', k=5, filter={'group': 'moved'}) == []
+    with pytest.raises(ValueError):
+        await searcher.adelete([ids[7]])
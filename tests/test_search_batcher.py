@@ -0,0 +1,37 @@
+import asyncio
+import threading
+import numpy as np
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from embeddings.search_batcher import SearchBatcher
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_lone_queries_go_out_at_once_and_the_rest_are_batched():
+    release = threading.Event()
+    batch_sizes = []
+
+    def search(vectors: np.ndarray, k: int):
+        batch_sizes.append(len(vectors))
+        release.wait(5)
+        return vectors[:, :1].repeat(k, axis=1), np.zeros((len(vectors), k), dtype=np.int64)
+
+    with ThreadPoolExecutor(1) as executor:
+        # a wait this long would time the test out if lone queries had to sit it out
+        batcher = SearchBatcher(executor, lambda: search, max_batch_size=64, max_wait=60)
+        first = asyncio.create_task(batcher.search(np.array([[0.0]]), 1))
+        await asyncio.sleep(0.05)
+        assert batch_sizes == [1]
+
+        # gathered while the first batch runs, then searched together
+        rest = [asyncio.create_task(batcher.search(np.array([[float(i)]]), 2)) for i in range(1, 4)]
+        await asyncio.sleep(0.05)
+        assert batch_sizes == [1]
+        release.set()
+        results = await asyncio.wait_for(asyncio.gather(first, *rest), 5)
+
+    assert batch_sizes == [1, 3]
+    assert [scores.tolist() for scores, _ in results] == [[[0.0]], [[1.0, 1.0]], [[2.0, 2.0]], [[3.0, 3.0]]]
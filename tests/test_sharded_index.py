@@ -0,0 +1,62 @@
+import fakeredis
+import numpy as np
+import pytest
+
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from embeddings.docstore import RedisStore
+from embeddings.index import ShardedIndex, create_flat_index, selector_search_params
+from embeddings.searcher import FaissSearcher
+from tests.test_docstore import DIM, HashEmbeddings
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('distance_strategy', [DistanceStrategy.EUCLIDEAN_DISTANCE, DistanceStrategy.MAX_INNER_PRODUCT])
+def test_selector_search_matches_a_single_index(distance_strategy):
+    faiss = dependable_faiss_import()
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((20000, DIM)).astype(np.float32)
+    keys = np.arange(len(vectors), dtype=np.int64)
+    sharded = ShardedIndex(DIM, distance_strategy, 8)
+    sharded.add_with_ids(vectors, keys)
+    reference = faiss.IndexIDMap2(create_flat_index(DIM, distance_strategy))
+    reference.add_with_ids(vectors, keys)
+
+    allowed = faiss.IDSelectorBatch(rng.choice(keys, 500, replace=False))
+    queries = rng.standard_normal((64, DIM)).astype(np.float32)
+    # the tombstone selector of FaissSearcher, and a filter selector
+    for selector in (faiss.IDSelectorNot(allowed), allowed):
+        for _ in range(10):
+            scores, found = sharded.search(queries, 10, params=selector_search_params(sharded, selector))
+            expected_scores, expected = reference.search(queries, 10, params=faiss.SearchParameters(sel=selector))
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+            assert all(selector.is_member(int(key)) for key in found.ravel())
+
+    # fewer matches than k are padded with -1 after the real hits
+    few = faiss.IDSelectorBatch(keys[:3])
+    _, found = sharded.search(queries[:2], 5, params=selector_search_params(sharded, few))
+    assert sorted(found[0, :3]) == [0, 1, 2] and list(found[:, 3:].ravel()) == [-1] * 4
+
+
+async def test_searcher_with_shards_and_tombstones():
+    store = RedisStore(url='redis://localhost', index_name='test', batch_size=64)
+    store.client = fakeredis.FakeAsyncRedis()
+    searcher = FaissSearcher(store, DIM, HashEmbeddings(), num_shards=4, search_workers=4)
+    searcher.exhaustive_filter_limit = 8
+    try:
+        texts = [f'text {i}' for i in range(400)]
+        ids = await searcher.aadd_texts(texts, [{'group': i % 2} for i in range(400)])
+        await searcher.adelete(ids[:10])
+        assert searcher._tombstones
+
+        found = await searcher.asimilarity_search('text 20', k=3)
+        assert found[0].page_content == 'text 20'
+        everything = await searcher.asimilarity_search('text 5', k=400)
+        assert sorted(doc.page_content for doc in everything) == sorted(texts[10:])
+        filtered = await searcher.asimilarity_search('text 21', k=20, filter={'group': 1})
+        assert filtered[0].page_content == 'text 21'
+        assert all(doc.metadata['group'] == 1 and doc.page_content not in texts[:10] for doc in filtered)
+    finally:
+        await store.aclose()